@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 """melee-gci-compiler.py: Compiles custom data into Melee GCI save files using
    MGC script files"""
+import os
 import sys
 import getopt
 import hashlib
+import shutil
+import tempfile
 from pathlib import Path
 import mgc.compiler as compiler
 import mgc.logger as logger
@@ -19,14 +22,25 @@ script_path    The path to the MGC script file you want to compile.
 --nopack       Do not pack the GCI, so you can inspect the outputted data.
 --silent       Suppress command line output, except for fatal errors.
 --debug        Output extra information while compiling and on errors.
+--nocache      Don't read or write the cache of compiled ASM and parsed MGC files.
+--checksum     Recompute the checksum of every block of the input GCI,
+               repairing any that are wrong. Otherwise only the blocks that
+               the script changes get new checksums.
+--mmap         Compile into the output GCI in place through a memory map,
+               instead of writing a copy. Requires -i and -o, which may be
+               the same file to patch it in place.
+--peek         Print data from the input GCI at a Melee address, given as
+               address:length (eg. 80461830:0xc), without compiling.
 
 You can omit script_path to pack or unpack a GCI without changing its content.
+Compiled ASM and parsed MGC files are cached in your user cache directory
+between builds; set MGC_CACHE_DIR to use a different directory.
 """
 
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv[1:],'i:o:h',['help','nopack','silent','debug'])
+        opts, args = getopt.getopt(argv[1:],'i:o:h',['help','nopack','silent','debug','nocache','mmap','checksum','peek='])
     except getopt.GetoptError:
         return 2
     if len(args) > 1:
@@ -39,8 +53,12 @@ def main(argv):
     nopack = False
     silent = False
     debug = False
+    use_mmap = False
+    use_cache = True
+    checksum_all = False
     usage = False
     error = False
+    peeks = []
     for opt, arg in opts:
         match opt:
             case '-h'|'--help': usage = True
@@ -49,27 +67,72 @@ def main(argv):
             case '--nopack': nopack = True
             case '--silent': silent = True
             case '--debug': debug = True
+            case '--nocache': use_cache = False
+            case '--mmap': use_mmap = True
+            case '--checksum': checksum_all = True
+            case '--peek': peeks.append(arg)
             case _: error = True
     if usage:
         print(USAGE_TEXT)
         return 0
     if error:
         return 2
+    if peeks:
+        if not input_gci or script_path:
+            return 2
+        return _peek(input_gci, peeks, silent, debug)
+    copied_gci = None
+    if use_mmap:
+        if not input_gci or not output_gci:
+            return 2
+        if not Path(input_gci).is_file():
+            logger.error(f"Input GCI not found: {input_gci}")
+            return 10
+        if not _same_file(input_gci, output_gci):
+            # Compile into a copy next to the output, which only replaces
+            # the output once the compile succeeds
+            try:
+                copied_gci = _copy_gci(input_gci, output_gci)
+            except OSError as e:
+                logger.error(f"Couldn't write GCI file: {e}")
+                return 10
+            input_gci = copied_gci
+        else:
+            input_gci = output_gci
     if not script_path:
         logger.warning("No MGC script specified; no custom data will be compiled")
     try:
         gci_data = compiler.init(script_path, input_gci_path=input_gci,
-                                 nopack=nopack, silent=silent, debug=debug)
+                                 nopack=nopack, silent=silent, debug=debug,
+                                 use_mmap=use_mmap, use_cache=use_cache,
+                                 checksum_all=checksum_all)
+        md5 = hashlib.md5(gci_data).hexdigest()
+        if copied_gci:
+            gci_data.close()
+            os.replace(copied_gci, output_gci)
+            copied_gci = None
     except CompileError as e:
         if debug:
             raise
         else:
             logger.error(e.message)
-            _cleanup(script_path)
             return 10
+    except OSError as e:
+        if debug:
+            raise
+        logger.error(f"Couldn't write GCI file: {e}")
+        return 10
+    finally:
+        if copied_gci:
+            try:
+                Path(copied_gci).unlink(missing_ok=True)
+            except OSError:
+                pass
     logger.info("Compile successful")
     if not output_gci:
         logger.info("No output GCI specified; no files will be written")
+    elif use_mmap:
+        logger.info("GCI file was written in place")
     else:
         if nopack:
             msg = "Writing unpacked GCI file; not loadable by Melee"
@@ -77,13 +140,54 @@ def main(argv):
             msg = "Writing final GCI file"
         logger.info(msg)
         _write_gci(output_gci, gci_data, debug)
-    md5 = hashlib.md5(gci_data).hexdigest()
     logger.info(f"MD5: {md5}")
     logger.info("All tasks finished")
-    _cleanup(script_path)
     return 0
 
 
+def _peek(input_gci: str, peeks: list[str], silent: bool, debug: bool) -> int:
+    """Prints data at each address:length pair from the input GCI."""
+    for p in peeks:
+        try:
+            address, length = p.split(':')
+            address = int(address, 16)
+            length = int(length, 0)
+        except ValueError:
+            return 2
+        try:
+            data = compiler.peek(input_gci, address, length, silent=silent, debug=debug)
+        except CompileError as e:
+            if debug:
+                raise
+            logger.error(e.message)
+            return 10
+        print(f"{address:08x}: {data.hex(' ')}")
+    return 0
+
+
+def _same_file(path1: str, path2: str) -> bool:
+    """Checks whether two paths point to the same file."""
+    try:
+        return Path(path1).samefile(path2)
+    except OSError:
+        return False
+
+
+def _copy_gci(input_gci: str, output_gci: str) -> str:
+    """Copies the input GCI to a temp file in the output's directory, with
+    the permissions of the file it will replace, and returns its path."""
+    fd, path = tempfile.mkstemp(dir=Path(output_gci).resolve().parent, suffix='.gci')
+    os.close(fd)
+    try:
+        shutil.copyfile(input_gci, path)
+        mode_source = output_gci if Path(output_gci).exists() else input_gci
+        shutil.copymode(mode_source, path)
+    except OSError:
+        Path(path).unlink(missing_ok=True)
+        raise
+    return path
+
+
 def _write_gci(path: str, data: bytes, debug: bool):
     try:
         with open(path, 'wb') as f: f.write(data)
@@ -94,23 +198,6 @@ def _write_gci(path: str, data: bytes, debug: bool):
             logger.error(f"Couldn't write GCI file: {e}")
 
 
-def _cleanup(script_path):
-    """Deletes temp files generated by the ASM compiler."""
-    if not script_path:
-        return
-    tmp_path = Path(script_path).parent/"tmp"
-    (tmp_path/"code.txt").unlink(missing_ok=True)
-    (tmp_path/"code.bin").unlink(missing_ok=True)
-    (tmp_path/"src1.o").unlink(missing_ok=True)
-    (tmp_path/"src2.o").unlink(missing_ok=True)
-    # Remove tmp directory only if empty
-    try:
-        tmp_path.rmdir()
-    except Exception:
-        pass
-    return
-
-
 if __name__ == "__main__":
     r = main(sys.argv)
     if r == 2:
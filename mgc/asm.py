@@ -1,56 +1,382 @@
 """asm.py: Compiles ASM using pyiiasmh."""
+import os
 import re
+import hashlib
+import tempfile
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from typing import NamedTuple
 from .pyiiasmh import ppctools
 from .errors import BuildError
+from .context import Context
 from . import context
+from . import asm_cache
+from . import asm_native
 
-def _make_tmp_directory():
-    root = context.root()
-    tmp_directory = root.path.parent/'tmp'
+# Directives that change sections can't be wrapped in a batch section
+_SECTION_DIRECTIVE = re.compile(r'^\s*\.(section|text|data|bss|previous|pushsection|popsection)\b', re.M)
+_LABEL = re.compile(r'^\s*([A-Za-z_.$][\w.$]*)\s*:', re.M)
+_SYMBOL_DIRECTIVE = re.compile(r'^\s*\.(?:set|equ|equiv|eqv|macro)\s+([A-Za-z_.$][\w.$]*)', re.M)
+_TOKEN = re.compile(r'[A-Za-z_.$][\w.$]*')
+_backend_source_hash: str = None
+
+
+class AsmJob(NamedTuple):
+    """An ASM block waiting to be compiled. c2_ba is the injection address if
+    it's a C2 block, or None, and the context is used for error logging."""
+    asm: list[str]
+    c2_ba: int
+    context: Context
+
+
+def _tmp_root() -> Path:
+    """Returns the directory to create job workspaces in, preferring tmpfs
+    so the assembler's files never touch the disk. None means the system
+    default."""
+    shm = Path('/dev/shm')
+    if shm.is_dir() and os.access(shm, os.W_OK):
+        return shm
+    return None
+
+
+_TMP_ROOT = _tmp_root()
+# Upper bound on how many blocks are assembled at the same time
+MAX_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def _workspace() -> tempfile.TemporaryDirectory:
+    """Creates a private temp directory for one assembler run, so concurrent
+    compiles never share files."""
+    return tempfile.TemporaryDirectory(prefix='mgc-', dir=_TMP_ROOT)
+
+
+def _parse_error(e: RuntimeError) -> tuple[int, str]:
+    """Gets the line number and message from an assembler error, or None if
+    it isn't in the expected format."""
+    r = re.search(r'(?:code\.txt|\{standard input\})\:(\d+)\: Error: (.*?)\\', str(e))
+    if not r:
+        return None
+    return int(r.group(1)), r.group(2)
+
+
+def _raise_error(e: Exception, c: Context, asm_line_number: int=None) -> None:
+    """Raises a BuildError for an assembler exception, pointing the context
+    at the offending ASM line if there is one."""
+    if isinstance(e, BuildError):
+        raise e
+    if not isinstance(e, RuntimeError):
+        raise BuildError(f"Error compiling ASM: {e}")
+    r = _parse_error(e)
+    if not r:
+        raise BuildError(f"Error compiling ASM")
+    line_number, error = r
+    if asm_line_number is None:
+        asm_line_number = line_number
+    if c.line_number:
+        c.line_number += asm_line_number
+    else:
+        c.line_number = asm_line_number
+    raise BuildError(f"Error compiling ASM: {error}")
+
+
+def _assemble_native(asm: list[str]) -> bytes:
+    """Assembles one block in-process, or returns None if it needs
+    binutils."""
     try:
-        tmp_directory.mkdir(exist_ok=True)
-    except FileNotFoundError:
-        raise BuildError("Unable to create tmp directory")
-    return tmp_directory
+        return asm_native.assemble('\n'.join(line.rstrip('\n') for line in asm))
+    except asm_native.Unsupported:
+        return None
+
 
+def _assemble(asm: list[str]) -> bytes:
+    """Assembles one block, natively or through pipes if possible, or
+    otherwise in its own workspace. Doesn't touch the context stack, so it's
+    safe to run on worker threads."""
+    compiled_asm = _assemble_native(asm)
+    if compiled_asm is not None:
+        return compiled_asm
+    source = '\n'.join(line.rstrip('\n') for line in asm)
+    if ppctools.use_pipes:
+        compiled_asm = ppctools.pipe_opcodes(source)
+        if compiled_asm is not None:
+            return compiled_asm
+    with _workspace() as tmp:
+        tmp_dir = Path(tmp)
+        with open(tmp_dir/"code.txt", 'w') as f:
+            f.write(source)
+        return bytes.fromhex(ppctools.asm_opcodes(tmp_dir))
 
-def _compile(asm: list[str]) -> str:
-    tmp_dir = _make_tmp_directory()
-    txtfile = tmp_dir/"code.txt"
-    with open(txtfile, 'w') as f:
-        f.write('\n'.join(asm))
+
+def _compile(asm: list[str]) -> bytes:
     with context.top() as c:
         try:
-            compiled_asm = ppctools.asm_opcodes(tmp_dir)
-        except RuntimeError as e:
-            r = re.search(r'code\.txt\:(\d+)\: Error: (.*?)\\', str(e))
-            if r:
-                asm_line_number = int(r.group(1))
-                error = r.group(2)
-                if c.line_number:
-                    c.line_number += asm_line_number
-                else:
-                    c.line_number = asm_line_number
-                raise BuildError(f"Error compiling ASM: {error}")
-            else:
-                raise BuildError(f"Error compiling ASM")
+            compiled_asm = _assemble(asm)
         except Exception as e:
-            raise BuildError(f"Error compiling ASM: {e}")
+            _raise_error(e, c)
     return compiled_asm
 
 
-def compile_asm(asm: list[str]) -> bytes:
-    """Takes ASM and compiles it to hex using pyiiasmh."""
-    return bytes.fromhex(_compile(asm))
+def _backend_hash() -> str:
+    """Hashes the source of the assembler backends, so output cached by a
+    different version of them is never used."""
+    global _backend_source_hash
+    if _backend_source_hash is None:
+        h = hashlib.sha256()
+        backend = Path(ppctools.__file__)
+        for path in (Path(asm_native.__file__), backend, backend.with_name('elf.py')):
+            h.update(path.read_bytes())
+        _backend_source_hash = h.hexdigest()
+    return _backend_source_hash
+
+
+def _cache_key(asm: list[str], c2_ba: int) -> str:
+    if c2_ba is None:
+        return asm_cache.key('asm', _backend_hash(), '\n'.join(asm))
+    return asm_cache.key('c2', _backend_hash(), "%08x" % c2_ba, '\n'.join(asm))
 
 
-def compile_c2(asm: list[str], c2_ba: int) -> bytes:
-    """Takes ASM and compiles it into a C2 code using pyiiasmh."""
-    compiled_asm = _compile(asm)
-    c2_ba_str = "%08x" % c2_ba
+def _construct(compiled_asm: bytes, c2_ba: int) -> bytes:
+    """Turns compiled ASM into the final bytes for its block type."""
+    if c2_ba is None:
+        return compiled_asm
     try:
-        compiled_c2 = ppctools.construct_code(compiled_asm, bapo=c2_ba_str, ctype='C2D2')
+        return ppctools.construct_code_bytes(compiled_asm, c2_ba, ctype='C2D2')
     except Exception as e:
         raise BuildError(f"Error compiling ASM: {e}")
-    return bytes.fromhex(compiled_c2)
 
+
+def _compile_cached(asm: list[str], c2_ba: int) -> bytes:
+    key = _cache_key(asm, c2_ba)
+    data = asm_cache.get(key)
+    if data is None:
+        data = _construct(_compile(asm), c2_ba)
+        asm_cache.put(key, data)
+    return data
+
+
+def compile_asm(asm: list[str]) -> bytes:
+    """Takes ASM and compiles it to bytes using pyiiasmh."""
+    return _compile_cached(asm, None)
+
+
+class _Failure(NamedTuple):
+    """An error compiling one block, raised once its result is needed.
+    asm_line_number overrides the line number in the assembler's message."""
+    error: Exception
+    asm_line_number: int = None
+
+
+class PendingAsm:
+    """The bytes of an ASM block that's compiling in the background. Any
+    error is raised from result(), in the block's own context."""
+
+    def __init__(self, future: Future, index: int, job: AsmJob):
+        self._future = future
+        self._index = index
+        self._job = job
+
+    def result(self) -> bytes:
+        """Waits for the block to finish compiling and returns its bytes."""
+        return _resolve(self._job, self._future.result()[self._index])
+
+    @classmethod
+    def completed(cls, data: bytes) -> 'PendingAsm':
+        """Wraps bytes that are already compiled."""
+        future = Future()
+        future.set_result([data])
+        return cls(future, 0, None)
+
+
+_pools: dict[str, ThreadPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(name: str) -> ThreadPoolExecutor:
+    """Returns a persistent thread pool, shared by every compile in the
+    process: 'files' runs each file's compile in the background, and
+    'toolchain' runs the assembler jobs."""
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                                              thread_name_prefix=f'mgc-{name}')
+        return _pools[name]
+
+
+def start_workers() -> None:
+    """Probes the toolchain on a worker thread, so it's ready by the time
+    the first block needs it."""
+    _submit(_pool('toolchain'), _probe_toolchain)
+
+
+def _probe_toolchain() -> None:
+    try:
+        ppctools.toolchain()
+    except OSError:
+        # Reported when a block actually needs the toolchain
+        pass
+
+
+def submit_jobs(jobs: list[AsmJob]) -> list[PendingAsm]:
+    """Starts compiling a list of ASM blocks in the background, and returns
+    a pending result for each."""
+    future = _submit(_pool('files'), _compile_jobs, jobs)
+    return [PendingAsm(future, i, job) for i, job in enumerate(jobs)]
+
+
+def on_compiled(pending: list[PendingAsm], fn) -> None:
+    """Calls fn with the bytes of each block from one submit_jobs call once
+    they've all compiled, unless any of them failed. fn may run on a worker
+    thread."""
+    if not pending:
+        fn([])
+        return
+
+    def done(future: Future):
+        if future.exception():
+            return
+        results = [future.result()[p._index] for p in pending]
+        if not any(isinstance(r, _Failure) for r in results):
+            fn(results)
+
+    pending[0]._future.add_done_callback(done)
+
+
+def _resolve(job: AsmJob, result) -> bytes:
+    if isinstance(result, _Failure):
+        with job.context.copy() as c:
+            _raise_error(result.error, c, result.asm_line_number)
+    return result
+
+
+def _compile_jobs(jobs: list[AsmJob]) -> list:
+    """Compiles a list of ASM blocks, assembling as many of them as possible
+    together in a single toolchain run, and running independent toolchain
+    runs concurrently. Returns the bytes of each block, or a _Failure.
+    Doesn't touch the context stack, so it can run in the background."""
+    results = [None] * len(jobs)
+    keys = [_cache_key(job.asm, job.c2_ba) for job in jobs]
+
+    def finish(i, compiled_asm):
+        try:
+            results[i] = _construct(compiled_asm, jobs[i].c2_ba)
+        except BuildError as e:
+            results[i] = _Failure(e)
+            return
+        asm_cache.put(keys[i], results[i])
+
+    pending = []
+    for i, key in enumerate(keys):
+        results[i] = asm_cache.get(key)
+        if results[i] is None:
+            pending.append(i)
+    # Most blocks don't need binutils at all
+    for i in pending:
+        compiled_asm = _assemble_native(jobs[i].asm)
+        if compiled_asm is not None:
+            finish(i, compiled_asm)
+    pending = [i for i in pending if results[i] is None]
+    if not pending:
+        return results
+    batchable = [i for i in pending if not _SECTION_DIRECTIVE.search('\n'.join(jobs[i].asm))]
+    batches = [batch for batch in _group(jobs, batchable) if len(batch) > 1]
+    batched = {i for batch in batches for i in batch}
+    singles = [i for i in pending if i not in batched]
+    pool = _pool('toolchain')
+    batch_futures = [(batch, _submit(pool, _assemble_batch, [jobs[i].asm for i in batch]))
+                     for batch in batches]
+    futures = {i: _submit(pool, _assemble, jobs[i].asm) for i in singles}
+    for batch, future in batch_futures:
+        compiled = _batch_result(jobs, batch, future)
+        if isinstance(compiled, tuple):
+            # One block has an error; compile the others separately
+            i, failure = compiled
+            results[i] = failure
+            futures.update((j, _submit(pool, _assemble, jobs[j].asm)) for j in batch if j != i)
+        elif compiled is None:
+            # Compile the blocks separately instead
+            futures.update((i, _submit(pool, _assemble, jobs[i].asm)) for i in batch)
+        else:
+            for i, compiled_asm in zip(batch, compiled):
+                finish(i, compiled_asm)
+    for i, future in futures.items():
+        try:
+            compiled_asm = future.result()
+        except Exception as e:
+            results[i] = _Failure(e)
+            continue
+        finish(i, compiled_asm)
+    return results
+
+
+def _submit(pool: ThreadPoolExecutor, fn, *args) -> Future:
+    """Submits a job to the pool, carrying over context variables such as
+    the toolchain runner."""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+def _group(jobs: list[AsmJob], indexes: list[int]) -> list[list[int]]:
+    """Splits jobs into batches that can be assembled together. Labels are
+    global to the assembler, so a block can't share a batch with another
+    block that defines a symbol it uses or defines itself."""
+    batches = []
+    for i in indexes:
+        text = '\n'.join(jobs[i].asm)
+        defined = set(_LABEL.findall(text)) | set(_SYMBOL_DIRECTIVE.findall(text))
+        tokens = set(_TOKEN.findall(text))
+        for batch, batch_defined, batch_tokens in batches:
+            if not (defined & batch_tokens) and not (tokens & batch_defined):
+                batch.append(i)
+                batch_defined |= defined
+                batch_tokens |= tokens
+                break
+        else:
+            batches.append(([i], defined, tokens))
+    return [batch for batch, _, _ in batches]
+
+
+def _assemble_batch(blocks: list[list[str]]) -> list[bytes]:
+    """Assembles several blocks with one toolchain run, each in its own
+    section, and returns the bytes of each. Safe to run on worker threads."""
+    source = []
+    names = []
+    for n, asm in enumerate(blocks):
+        names.append(f".mgc{n}")
+        source.append(f'.section .mgc{n},"ax"')
+        source += [line.rstrip('\n') for line in asm]
+    source = '\n'.join(source) + '\n'
+    sections = None
+    if ppctools.use_pipes:
+        sections = ppctools.pipe_sections(source, names)
+    if sections is None:
+        with _workspace() as tmp:
+            tmp_dir = Path(tmp)
+            with open(tmp_dir/"code.txt", 'w') as f:
+                f.write(source)
+            sections = ppctools.asm_sections(tmp_dir, names)
+    return sections
+
+
+def _batch_result(jobs: list[AsmJob], batch: list[int], future: Future):
+    """Gets the result of a batch compile. Returns None if the blocks need to
+    be compiled separately instead, or the index and _Failure of the block
+    with an error."""
+    try:
+        return future.result()
+    except RuntimeError as e:
+        r = _parse_error(e)
+        if not r or 'already defined' in r[1]:
+            return None
+        # Map the error back to the block and line it came from; each block
+        # is preceded by its section directive
+        line_number = r[0]
+        start = 0
+        for i in batch:
+            end = start + 1 + len(jobs[i].asm)
+            if line_number <= end:
+                break
+            start = end
+        return i, _Failure(e, line_number - start - 1)
+    except Exception:
+        return None
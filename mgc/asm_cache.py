@@ -0,0 +1,119 @@
+"""asm_cache.py: A persistent on-disk cache of compiled ASM, shared between
+builds. Entries are keyed by a hash of the ASM source, its compile
+parameters, the assembler backends' source and the toolchain binaries, so
+they never need invalidating."""
+import os
+import hashlib
+import platform
+import tempfile
+from pathlib import Path
+from .pyiiasmh import ppctools
+from . import logger
+
+
+MAX_CACHE_SIZE = 32 * 1024 * 1024
+# How many new entries to write between eviction passes
+EVICT_INTERVAL = 64
+enabled = True
+cache_dir: Path = None
+_puts = 0
+
+
+def _default_cache_dir() -> Path:
+    """Returns the per-user cache directory."""
+    if os.environ.get('MGC_CACHE_DIR'):
+        return Path(os.environ['MGC_CACHE_DIR'])
+    if platform.system().lower() == 'windows':
+        base = os.environ.get('LOCALAPPDATA') or Path.home()
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or Path.home()/'.cache'
+    return Path(base)/'melee-gci-compiler'/'asm'
+
+
+def key(*parts: str) -> str:
+    """Returns the cache key for compiling some ASM with the given
+    parameters, or None if caching is unavailable."""
+    if not enabled:
+        return None
+    try:
+        toolchain = ppctools.toolchain_hash()
+    except OSError:
+        return None
+    h = hashlib.sha256(toolchain.encode())
+    for part in parts:
+        h.update(b'\0' + part.encode())
+    return h.hexdigest()
+
+
+def _path(key: str) -> Path:
+    return (cache_dir or _default_cache_dir())/key[:2]/key
+
+
+def get(key: str) -> bytes:
+    """Returns the cached data for a key, or None on a cache miss."""
+    if not key:
+        return None
+    path = _path(key)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    # Mark the entry as recently used for eviction, which a read-only or
+    # shared cache directory may not allow
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    logger.debug(f"Using cached ASM {key[:12]}")
+    return data
+
+
+def put(key: str, data: bytes) -> None:
+    """Stores data in the cache. The entry is written to a temp file first
+    and renamed into place, so concurrent builds never see partial
+    entries."""
+    global _puts
+    if not key:
+        return
+    path = _path(key)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+    except OSError as e:
+        logger.debug(f"Unable to write ASM cache entry: {e}")
+        return
+    if _puts % EVICT_INTERVAL == 0:
+        evict()
+    _puts += 1
+
+
+def evict(max_size: int=MAX_CACHE_SIZE) -> None:
+    """Deletes the least recently used entries until the cache fits within
+    max_size bytes."""
+    root = cache_dir or _default_cache_dir()
+    entries = []
+    total = 0
+    for path in root.glob('*/*'):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total -= size
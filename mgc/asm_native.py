@@ -0,0 +1,534 @@
+"""asm_native.py: An in-process assembler for the common subset of Gekko
+instructions, so most ASM blocks compile without running binutils. Anything
+it doesn't understand raises Unsupported and is left to powerpc-eabi-as,
+which also produces the error messages for invalid code."""
+import re
+
+enabled = True
+
+
+class Unsupported(Exception):
+    """Raised for source the native assembler can't handle."""
+
+
+_GPRS = {f'r{n}': n for n in range(32)}
+_GPRS.update(sp=1, rtoc=2)
+_FPRS = {f'f{n}': n for n in range(32)}
+_CRFS = {f'cr{n}': n for n in range(8)}
+_SPRS = {'xer': 1, 'lr': 8, 'ctr': 9}
+
+# Instructions with no operands
+_FIXED = {
+    'blr': 0x4e800020, 'blrl': 0x4e800021, 'bctr': 0x4e800420,
+    'bctrl': 0x4e800421, 'sync': 0x7c0004ac, 'isync': 0x4c00012c,
+    'eieio': 0x7c0006ac, 'nop': 0x60000000, 'trap': 0x7fe00008,
+    'rfi': 0x4c000064,
+}
+# rD, rA, SIMM
+_D_ARITH = {'addi': 14, 'addis': 15, 'addic': 12, 'addic.': 13, 'subfic': 8, 'mulli': 7}
+# rA, rS, UIMM
+_D_LOGICAL = {'ori': 24, 'oris': 25, 'xori': 26, 'xoris': 27, 'andi.': 28, 'andis.': 29}
+# rD, d(rA)
+_LOAD_STORE = {
+    'lwz': 32, 'lwzu': 33, 'lbz': 34, 'lbzu': 35, 'stw': 36, 'stwu': 37,
+    'stb': 38, 'stbu': 39, 'lhz': 40, 'lhzu': 41, 'lha': 42, 'lhau': 43,
+    'sth': 44, 'sthu': 45, 'lmw': 46, 'stmw': 47,
+}
+# frD, d(rA)
+_FLOAT_LOAD_STORE = {
+    'lfs': 48, 'lfsu': 49, 'lfd': 50, 'lfdu': 51, 'stfs': 52, 'stfsu': 53,
+    'stfd': 54, 'stfdu': 55,
+}
+# rD, rA, rB with o and . forms
+_XO_ARITH = {
+    'add': 266, 'addc': 10, 'adde': 138, 'subf': 40, 'subfc': 8,
+    'subfe': 136, 'mullw': 235, 'divw': 491, 'divwu': 459,
+}
+# rD, rA with o and . forms
+_XO_UNARY = {'neg': 104, 'addze': 202, 'addme': 234, 'subfze': 200, 'subfme': 232}
+# rA, rS, rB with . forms
+_X_LOGICAL = {
+    'and': 28, 'or': 444, 'xor': 316, 'nor': 124, 'nand': 476, 'andc': 60,
+    'orc': 412, 'eqv': 284, 'slw': 24, 'srw': 536, 'sraw': 792,
+}
+# rA, rS with . forms
+_X_UNARY = {'extsb': 954, 'extsh': 922, 'cntlzw': 26}
+# rD, rA, rB
+_X_INDEXED = {
+    'lwzx': 23, 'lwzux': 55, 'lbzx': 87, 'lbzux': 119, 'stwx': 151,
+    'stwux': 183, 'stbx': 215, 'stbux': 247, 'lhzx': 279, 'lhzux': 311,
+    'lhax': 343, 'lhaux': 375, 'sthx': 407, 'sthux': 439,
+}
+# rA, rB
+_CACHE = {'icbi': 982, 'dcbf': 86, 'dcbst': 54, 'dcbi': 470, 'dcbz': 1014, 'dcbt': 278, 'dcbtst': 246}
+# frD, frB with . forms
+_FLOAT_UNARY = {'fmr': 72, 'fneg': 40, 'fabs': 264, 'fnabs': 136, 'frsp': 12, 'fctiwz': 15}
+# frD, frA, frB with . forms: (primary opcode, extended opcode)
+_FLOAT_ARITH = {
+    'fadd': (63, 21), 'fsub': (63, 20), 'fdiv': (63, 18),
+    'fadds': (59, 21), 'fsubs': (59, 20), 'fdivs': (59, 18),
+}
+# frD, frA, frC with . forms
+_FLOAT_MUL = {'fmul': 63, 'fmuls': 59}
+# (BO, CR bit) for each branch condition
+_CONDITIONS = {
+    'lt': (12, 0), 'le': (4, 1), 'eq': (12, 2), 'ge': (4, 0), 'gt': (12, 1),
+    'nl': (4, 0), 'ne': (4, 2), 'ng': (4, 1), 'so': (12, 3), 'ns': (4, 3),
+    'un': (12, 3), 'nu': (4, 3),
+}
+_COND_BRANCH = re.compile(r'b(lt|le|eq|ge|gt|nl|ne|ng|so|ns|un|nu|dnz|dz)(lr|ctr)?(l)?(a)?([+-])?$')
+
+_LABEL = re.compile(r'([A-Za-z_.$][\w.$]*):')
+_MEMORY = re.compile(r'(.*)\((\w+)\)$')
+_TOKEN = re.compile(r'\s*(0[xX][0-9a-fA-F]+|0[bB][01]+|\d+|[A-Za-z_.$][\w.$]*|<<|>>|[-+*/%&|^~()@])')
+
+
+def assemble(source: str) -> bytes:
+    """Assembles source text. Raises Unsupported if it uses anything outside
+    the supported subset."""
+    if not enabled:
+        raise Unsupported()
+    # First pass: find labels and the address of each statement
+    statements = []
+    labels = {}
+    address = 0
+    for line in source.split('\n'):
+        line = line.split('#', 1)[0].strip()
+        if ';' in line or '/*' in line or '"' in line or "'" in line:
+            raise Unsupported()
+        while (m := _LABEL.match(line)):
+            name = m.group(1)
+            if name in labels or _is_register(name):
+                raise Unsupported()
+            labels[name] = address
+            line = line[m.end():].strip()
+        if not line:
+            continue
+        mnemonic, _, operands = line.replace('\t', ' ').partition(' ')
+        mnemonic = mnemonic.lower()
+        operands = [o.strip() for o in operands.split(',')] if operands.strip() else []
+        if mnemonic == '.long':
+            size = 4 * len(operands)
+        elif mnemonic.startswith('.'):
+            raise Unsupported()
+        else:
+            size = 4
+        statements.append((address, mnemonic, operands))
+        address += size
+    # Second pass: encode
+    out = bytearray()
+    for address, mnemonic, operands in statements:
+        if mnemonic == '.long':
+            for operand in operands:
+                value = _constant(operand)
+                if not -0x80000000 <= value <= 0xffffffff:
+                    raise Unsupported()
+                out += (value & 0xffffffff).to_bytes(4, 'big')
+        else:
+            out += _encode(mnemonic, operands, address, labels).to_bytes(4, 'big')
+    return bytes(out)
+
+
+def _is_register(name: str) -> bool:
+    name = name.lower()
+    return name in _GPRS or name in _FPRS or name in _CRFS
+
+
+def _register(operand: str, names: dict[str, int], limit: int=32) -> int:
+    value = names.get(operand.lower())
+    if value is None:
+        if not operand.isdigit():
+            raise Unsupported()
+        value = int(operand)
+    if not 0 <= value < limit:
+        raise Unsupported()
+    return value
+
+
+def _gpr(operand: str) -> int:
+    return _register(operand, _GPRS)
+
+
+def _fpr(operand: str) -> int:
+    return _register(operand, _FPRS)
+
+
+def _crf(operand: str) -> int:
+    return _register(operand, _CRFS, 8)
+
+
+def _expression(tokens: list[str]) -> int:
+    """Evaluates a constant expression with GAS operator precedence:
+    multiplicative and shifts bind tightest, then bitwise, then additive."""
+    def primary():
+        if not tokens:
+            raise Unsupported()
+        token = tokens.pop(0)
+        if token == '(':
+            value = additive()
+            if not tokens or tokens.pop(0) != ')':
+                raise Unsupported()
+            return value
+        if token == '-':
+            return -primary()
+        if token == '+':
+            return primary()
+        if token == '~':
+            return ~primary()
+        if token[:2] in ('0x', '0X'):
+            return int(token, 16)
+        if token[:2] in ('0b', '0B'):
+            return int(token[2:], 2)
+        if token.isdigit():
+            if len(token) > 1 and token[0] == '0':
+                if '8' in token or '9' in token:
+                    raise Unsupported()
+                return int(token, 8)
+            return int(token)
+        raise Unsupported()
+
+    def binary(operand, operators):
+        def parse():
+            value = operand()
+            while tokens and tokens[0] in operators:
+                op = tokens.pop(0)
+                rhs = operand()
+                match op:
+                    case '*': value *= rhs
+                    case '/' | '%':
+                        if rhs == 0:
+                            raise Unsupported()
+                        q = abs(value) // abs(rhs)
+                        if (value < 0) != (rhs < 0):
+                            q = -q
+                        value = q if op == '/' else value - q * rhs
+                    case '<<':
+                        if not 0 <= rhs < 64:
+                            raise Unsupported()
+                        value <<= rhs
+                    case '>>':
+                        # GAS shifts right unsigned, so negative values
+                        # become huge instead of staying negative
+                        if not 0 <= rhs < 64 or value < 0:
+                            raise Unsupported()
+                        value >>= rhs
+                    case '&': value &= rhs
+                    case '|': value |= rhs
+                    case '^': value ^= rhs
+                    case '+': value += rhs
+                    case '-': value -= rhs
+            return value
+        return parse
+
+    multiplicative = binary(primary, ('*', '/', '%', '<<', '>>'))
+    bitwise = binary(multiplicative, ('&', '|', '^'))
+    additive = binary(bitwise, ('+', '-'))
+    value = additive()
+    if tokens:
+        raise Unsupported()
+    return value
+
+
+def _displacement(m: re.Match) -> str:
+    """The displacement of a d(rA) operand, which GAS requires."""
+    if not m.group(1).strip():
+        raise Unsupported()
+    return m.group(1)
+
+
+def _tokenize(text: str) -> list[str]:
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        m = _TOKEN.match(text, position)
+        if not m:
+            raise Unsupported()
+        tokens.append(m.group(1))
+        position = m.end()
+    return tokens
+
+
+def _constant(operand: str) -> int:
+    return _expression(_tokenize(operand))
+
+
+def _immediate(operand: str, signed: bool, unsigned: bool) -> int:
+    """Parses a 16-bit immediate, with optional @h/@ha/@l suffixes."""
+    tokens = _tokenize(operand)
+    suffix = None
+    if len(tokens) >= 2 and tokens[-2] == '@':
+        suffix = tokens[-1].lower()
+        tokens = tokens[:-2]
+    value = _expression(tokens)
+    if suffix:
+        # GAS rejects negative values split into unsigned fields
+        if value < 0 and not signed:
+            raise Unsupported()
+        match suffix:
+            case 'l': return value & 0xffff
+            case 'h': return (value >> 16) & 0xffff
+            case 'ha': return ((value + 0x8000) >> 16) & 0xffff
+            case _: raise Unsupported()
+    if signed and -0x8000 <= value <= 0x7fff:
+        return value & 0xffff
+    if unsigned and 0 <= value <= 0xffff:
+        return value
+    raise Unsupported()
+
+
+def _uint(operand: str, bits: int) -> int:
+    value = _constant(operand)
+    if not 0 <= value < (1 << bits):
+        raise Unsupported()
+    return value
+
+
+def _count(operands: list[str], *counts: int) -> None:
+    if len(operands) not in counts:
+        raise Unsupported()
+
+
+def _branch_target(operand: str, address: int, labels: dict[str, int], absolute: bool) -> int:
+    """Returns the displacement (or absolute address) a branch encodes.
+    Constant targets are displacements, like GAS treats them."""
+    tokens = _tokenize(operand)
+    if tokens and tokens[0] in labels:
+        if absolute:
+            raise Unsupported()
+        offset = _expression(tokens[1:]) if len(tokens) > 1 else 0
+        if len(tokens) > 1 and tokens[1] not in ('+', '-'):
+            raise Unsupported()
+        return labels[tokens[0]] + offset - address
+    return _expression(tokens)
+
+
+def _check_update(mnemonic: str, rd: int, ra: int) -> None:
+    """Rejects register combinations that are invalid for update and
+    multiple-word forms, which GAS reports as errors."""
+    load = mnemonic.startswith('l')
+    if mnemonic == 'lmw':
+        if ra >= rd:
+            raise Unsupported()
+    elif 'u' in mnemonic[2:] and mnemonic[0] in 'ls':
+        if ra == 0 or (load and ra == rd):
+            raise Unsupported()
+
+
+def _rc(mnemonic: str) -> tuple[str, int]:
+    if mnemonic.endswith('.'):
+        return mnemonic[:-1], 1
+    return mnemonic, 0
+
+
+def _encode(mnemonic: str, operands: list[str], address: int, labels: dict[str, int]) -> int:
+    if mnemonic in _FIXED:
+        _count(operands, 0)
+        return _FIXED[mnemonic]
+
+    if mnemonic in _D_ARITH or mnemonic in ('li', 'lis', 'la', 'subi', 'subis', 'subic', 'subic.'):
+        if mnemonic in ('li', 'lis'):
+            _count(operands, 2)
+            rd, ra, imm = operands[0], '0', operands[1]
+            opcode = 14 if mnemonic == 'li' else 15
+        elif mnemonic == 'la':
+            _count(operands, 2)
+            m = _MEMORY.match(operands[1])
+            if not m:
+                raise Unsupported()
+            rd, ra, imm = operands[0], m.group(2), _displacement(m)
+            opcode = 14
+        else:
+            _count(operands, 3)
+            rd, ra, imm = operands
+            if mnemonic in ('subi', 'subis', 'subic', 'subic.'):
+                opcode = _D_ARITH['add' + mnemonic[3:]]
+                imm = f'-({imm})'
+            else:
+                opcode = _D_ARITH[mnemonic]
+        # addis and lis also take 16-bit unsigned values
+        value = _immediate(imm, True, mnemonic in ('addis', 'lis'))
+        return opcode << 26 | _gpr(rd) << 21 | _gpr(ra) << 16 | value
+
+    if mnemonic in _D_LOGICAL:
+        _count(operands, 3)
+        ra, rs, imm = operands
+        return _D_LOGICAL[mnemonic] << 26 | _gpr(rs) << 21 | _gpr(ra) << 16 | _immediate(imm, False, True)
+
+    if mnemonic in _LOAD_STORE or mnemonic in _FLOAT_LOAD_STORE:
+        _count(operands, 2)
+        m = _MEMORY.match(operands[1])
+        if not m:
+            raise Unsupported()
+        if mnemonic in _LOAD_STORE:
+            opcode, rd = _LOAD_STORE[mnemonic], _gpr(operands[0])
+        else:
+            opcode, rd = _FLOAT_LOAD_STORE[mnemonic], _fpr(operands[0])
+        offset = _immediate(_displacement(m), True, False)
+        ra = _gpr(m.group(2))
+        _check_update(mnemonic, rd, ra)
+        return opcode << 26 | rd << 21 | ra << 16 | offset
+
+    if mnemonic in ('cmpwi', 'cmplwi', 'cmpw', 'cmplw'):
+        _count(operands, 2, 3)
+        crf = _crf(operands[0]) if len(operands) == 3 else 0
+        ra, b = operands[-2:]
+        if mnemonic == 'cmpwi':
+            return 11 << 26 | crf << 23 | _gpr(ra) << 16 | _immediate(b, True, False)
+        if mnemonic == 'cmplwi':
+            return 10 << 26 | crf << 23 | _gpr(ra) << 16 | _immediate(b, False, True)
+        xo = 0 if mnemonic == 'cmpw' else 32
+        return 31 << 26 | crf << 23 | _gpr(ra) << 16 | _gpr(b) << 11 | xo << 1
+
+    name, rc = _rc(mnemonic)
+    oe = 0
+    if name.endswith('o') and (name[:-1] in _XO_ARITH or name[:-1] in _XO_UNARY):
+        name, oe = name[:-1], 1
+    if name in _XO_ARITH or name == 'sub':
+        _count(operands, 3)
+        rd, ra, rb = operands
+        if name == 'sub':
+            name, ra, rb = 'subf', rb, ra
+        return (31 << 26 | _gpr(rd) << 21 | _gpr(ra) << 16 | _gpr(rb) << 11
+                | oe << 10 | _XO_ARITH[name] << 1 | rc)
+    if name in _XO_UNARY:
+        _count(operands, 2)
+        rd, ra = operands
+        return 31 << 26 | _gpr(rd) << 21 | _gpr(ra) << 16 | oe << 10 | _XO_UNARY[name] << 1 | rc
+    if name in _X_LOGICAL or name in ('mr', 'not'):
+        if name in ('mr', 'not'):
+            _count(operands, 2)
+            ra, rs, rb = operands[0], operands[1], operands[1]
+            name = 'or' if name == 'mr' else 'nor'
+        else:
+            _count(operands, 3)
+            ra, rs, rb = operands
+        return 31 << 26 | _gpr(rs) << 21 | _gpr(ra) << 16 | _gpr(rb) << 11 | _X_LOGICAL[name] << 1 | rc
+    if name in _X_UNARY:
+        _count(operands, 2)
+        ra, rs = operands
+        return 31 << 26 | _gpr(rs) << 21 | _gpr(ra) << 16 | _X_UNARY[name] << 1 | rc
+    if name == 'srawi':
+        _count(operands, 3)
+        ra, rs, sh = operands
+        return 31 << 26 | _gpr(rs) << 21 | _gpr(ra) << 16 | _uint(sh, 5) << 11 | 824 << 1 | rc
+    if name in ('rlwinm', 'rlwimi', 'rlwnm', 'slwi', 'srwi', 'clrlwi', 'clrrwi', 'rotlwi'):
+        if name in ('rlwinm', 'rlwimi', 'rlwnm'):
+            _count(operands, 5)
+            ra, rs, sh, mb, me = operands
+            mb, me = _uint(mb, 5), _uint(me, 5)
+            if name == 'rlwnm':
+                return 23 << 26 | _gpr(rs) << 21 | _gpr(ra) << 16 | _gpr(sh) << 11 | mb << 6 | me << 1 | rc
+            sh = _uint(sh, 5)
+        else:
+            _count(operands, 3)
+            ra, rs, n = operands
+            n = _uint(n, 5)
+            sh, mb, me = {
+                'slwi': (n, 0, 31 - n),
+                'srwi': ((32 - n) & 31, n, 31),
+                'clrlwi': (0, n, 31),
+                'clrrwi': (0, 0, 31 - n),
+                'rotlwi': (n, 0, 31),
+            }[name]
+        opcode = 20 if name == 'rlwimi' else 21
+        return opcode << 26 | _gpr(rs) << 21 | _gpr(ra) << 16 | sh << 11 | mb << 6 | me << 1 | rc
+    if name in _FLOAT_UNARY:
+        _count(operands, 2)
+        frd, frb = operands
+        return 63 << 26 | _fpr(frd) << 21 | _fpr(frb) << 11 | _FLOAT_UNARY[name] << 1 | rc
+    if name in _FLOAT_ARITH:
+        _count(operands, 3)
+        frd, fra, frb = operands
+        opcode, xo = _FLOAT_ARITH[name]
+        return opcode << 26 | _fpr(frd) << 21 | _fpr(fra) << 16 | _fpr(frb) << 11 | xo << 1 | rc
+    if name in _FLOAT_MUL:
+        _count(operands, 3)
+        frd, fra, frc = operands
+        return _FLOAT_MUL[name] << 26 | _fpr(frd) << 21 | _fpr(fra) << 16 | _fpr(frc) << 6 | 25 << 1 | rc
+    if rc:
+        raise Unsupported()
+
+    if mnemonic == 'fcmpu':
+        _count(operands, 3)
+        crf, fra, frb = operands
+        return 63 << 26 | _crf(crf) << 23 | _fpr(fra) << 16 | _fpr(frb) << 11
+    if mnemonic in _X_INDEXED:
+        _count(operands, 3)
+        rd, ra, rb = _gpr(operands[0]), _gpr(operands[1]), _gpr(operands[2])
+        _check_update(mnemonic, rd, ra)
+        return 31 << 26 | rd << 21 | ra << 16 | rb << 11 | _X_INDEXED[mnemonic] << 1
+    if mnemonic in _CACHE:
+        _count(operands, 2)
+        ra, rb = operands
+        return 31 << 26 | _gpr(ra) << 16 | _gpr(rb) << 11 | _CACHE[mnemonic] << 1
+
+    if mnemonic in ('mfspr', 'mtspr') or mnemonic[2:] in _SPRS and mnemonic[:2] in ('mf', 'mt'):
+        if mnemonic in ('mfspr', 'mtspr'):
+            _count(operands, 2)
+            if mnemonic == 'mfspr':
+                reg, spr = operands[0], _uint(operands[1], 10)
+            else:
+                spr, reg = _uint(operands[0], 10), operands[1]
+        else:
+            _count(operands, 1)
+            reg, spr = operands[0], _SPRS[mnemonic[2:]]
+        xo = 339 if mnemonic.startswith('mf') else 467
+        return 31 << 26 | _gpr(reg) << 21 | (spr & 0x1f) << 16 | (spr >> 5) << 11 | xo << 1
+    if mnemonic in ('mfcr', 'mfmsr', 'mtmsr'):
+        _count(operands, 1)
+        xo = {'mfcr': 19, 'mfmsr': 83, 'mtmsr': 146}[mnemonic]
+        return 31 << 26 | _gpr(operands[0]) << 21 | xo << 1
+    if mnemonic in ('mtcrf', 'mtcr'):
+        if mnemonic == 'mtcr':
+            _count(operands, 1)
+            crm, rs = 0xff, operands[0]
+        else:
+            _count(operands, 2)
+            crm, rs = _uint(operands[0], 8), operands[1]
+        return 31 << 26 | _gpr(rs) << 21 | crm << 12 | 144 << 1
+
+    if mnemonic in ('b', 'bl', 'ba', 'bla'):
+        _count(operands, 1)
+        absolute = mnemonic in ('ba', 'bla')
+        target = _branch_target(operands[0], address, labels, absolute)
+        if target & 3 or not -0x2000000 <= target <= 0x1fffffc:
+            raise Unsupported()
+        link = mnemonic in ('bl', 'bla')
+        return 18 << 26 | (target & 0x3fffffc) | absolute << 1 | link
+    m = _COND_BRANCH.match(mnemonic)
+    if m:
+        condition, register, link, absolute, hint = m.groups()
+        if condition in ('dnz', 'dz'):
+            if register == 'ctr':
+                raise Unsupported()
+            bo, bi = (16 if condition == 'dnz' else 18), 0
+            crf_operand = False
+        else:
+            bo, bi = _CONDITIONS[condition]
+            crf_operand = True
+        if register:
+            if absolute:
+                raise Unsupported()
+            _count(operands, 0, 1 if crf_operand else 0)
+            if operands:
+                bi += 4 * _crf(operands[0])
+            if hint == '+':
+                bo |= 1
+            xo = 16 if register == 'lr' else 528
+            return 19 << 26 | bo << 21 | bi << 16 | xo << 1 | bool(link)
+        _count(operands, 1, 2 if crf_operand else 1)
+        if len(operands) == 2:
+            bi += 4 * _crf(operands[0])
+        if absolute and hint:
+            raise Unsupported()
+        target = _branch_target(operands[-1], address, labels, bool(absolute))
+        if target & 3 or not -0x8000 <= target <= 0x7ffc:
+            raise Unsupported()
+        # The y bit flips the static prediction, which is taken for
+        # backward branches and not taken for forward ones
+        if hint == '+' and target >= 0 or hint == '-' and target < 0:
+            bo |= 1
+        return 16 << 26 | bo << 21 | bi << 16 | (target & 0xfffc) | bool(absolute) << 1 | bool(link)
+
+    raise Unsupported()
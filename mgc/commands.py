@@ -4,6 +4,7 @@ from typing import Callable
 from pathlib import Path
 from . import logger
 from .files import asm_file, bin_file, gecko_file, mgc_file
+from .asm import PendingAsm
 from .datatypes import CompilerState
 from .datatypes import WriteEntry, WriteEntryList
 from .errors import CompileError
@@ -129,14 +130,14 @@ def _compile_file(path: Path, state: CompilerState) -> CompilerState:
     return state
 
 
-def asm(data: bytes, state: CompilerState) -> CompilerState:
+def asm(data: PendingAsm, state: CompilerState) -> CompilerState:
     """Writes a compiled version of an ASM block to the write table."""
-    return write(data, state)
+    return write(data.result(), state)
 
 
-def c2(data: bytes, state: CompilerState) -> CompilerState:
+def c2(data: PendingAsm, state: CompilerState) -> CompilerState:
     """Writes a compiled version of a C2 ASM block to the write table."""
-    return write(data, state)
+    return write(data.result(), state)
 
 
 def macro(name: str, state: CompilerState) -> CompilerState:
@@ -1,12 +1,31 @@
 """compiler.py: Compiles MGC files into a block of data that is ready to write
 to the GCI."""
+import asyncio
+import subprocess
+import threading
 from pathlib import Path
 from . import logger
+from . import asm
+from . import asm_cache
+from .pyiiasmh import ppctools
 from .commands import src
 from .errors import CompileError
 from .gci_tools.meleegci import melee_gamedata
 from .datatypes import CompilerState
 
+# Aliases, logging and cache settings are module-level, so only one compile
+# can run at a time
+_compile_lock = threading.Lock()
+
+
+def _check_asm(state: CompilerState) -> None:
+    """Raises the first ASM error in every sourced MGC file, including blocks
+    whose commands never ran, like ones in macros that were never called."""
+    for op_lines in state.mgc_files.values():
+        for op in op_lines:
+            if op.command in ['asm', 'c2']:
+                op.args[-1].result()
+
 
 def _init_new_gci() -> melee_gamedata:
     """Creates a new gamedata object from the init_gci MGC script."""
@@ -14,6 +33,7 @@ def _init_new_gci() -> melee_gamedata:
     silent = logger.silent_log
     logger.silent_log = True
     state = src(str(init_gci_path), CompilerState())
+    _check_asm(state)
     gci_data = bytearray(0x16040)
     for w in state.write_table:
         gci_data[w.address:w.address+len(w.data)] = w.data
@@ -21,14 +41,18 @@ def _init_new_gci() -> melee_gamedata:
     return melee_gamedata(raw_bytes=gci_data)
 
 
-def _load_gci(gci_path: str) -> melee_gamedata:
-    """Creates a gamedata object by loading an existing GCI file."""
+def _load_gci(gci_path: str, use_mmap: bool=False) -> melee_gamedata:
+    """Creates a gamedata object by loading an existing GCI file. Blocks are
+    unpacked lazily, so blocks the script never touches are never decoded.
+    With use_mmap, the file is memory-mapped and modified in place."""
     try:
-        input_gci = melee_gamedata(filename=gci_path, packed=True)
+        input_gci = melee_gamedata(filename=gci_path, packed=True, use_mmap=use_mmap)
     except FileNotFoundError:
         raise CompileError(f"Input GCI not found: {gci_path}")
+    except (OSError, ValueError) as e:
+        raise CompileError(f"Unable to map input GCI: {e}")
     try:
-        input_gci.unpack()
+        input_gci.unpack(lazy=True)
     except Exception as e:
         raise CompileError(f"GCI decoder: {e}")
     gci_data = input_gci.raw_bytes
@@ -37,29 +61,91 @@ def _load_gci(gci_path: str) -> melee_gamedata:
     return input_gci
 
 
-def init(root_mgc_path: str=None, input_gci_path: str=None, silent=False, debug=False, nopack=False) -> bytearray:
+def init(root_mgc_path: str=None, input_gci_path: str=None, silent=False, debug=False, nopack=False,
+         use_mmap=False, use_cache=True, checksum_all=False) -> bytearray:
     """Begins compilation by taking a root MGC path and parameters, then
-    returns the raw bytes of the final GCI."""
+    returns the raw bytes of the final GCI. With use_mmap, the input GCI is
+    compiled in place and the returned data is its memory map. Only blocks
+    of the input GCI that change get new checksums, unless checksum_all is
+    set, which checksums every block and repairs any that are wrong."""
     logger.silent_log = silent
     logger.debug_log = debug
+    asm_cache.enabled = use_cache
+    asm.start_workers()
+    if debug:
+        try:
+            logger.debug(f"Using {ppctools.version()}")
+        except OSError:
+            pass
     if input_gci_path:
         logger.info("Loading and unpacking input GCI")
-        input_gci = _load_gci(input_gci_path)
+        input_gci = _load_gci(input_gci_path, use_mmap)
+        if checksum_all:
+            input_gci.mark_all_dirty()
     else:
         logger.info("Initializing new GCI")
         input_gci = _init_new_gci()
     if root_mgc_path:
         state = src(root_mgc_path, CompilerState())
+        _check_asm(state)
         for w in state.write_table:
-            input_gci.raw_bytes[w.address:w.address+len(w.data)] = w.data
+            input_gci.write(w.address, w.data)
         if state.block_order:
             input_gci.block_order = state.block_order
             input_gci.reorder_blocks()
         for w in state.patch_table:
-            input_gci.raw_bytes[w.address:w.address+len(w.data)] = w.data
+            input_gci.write(w.address, w.data)
     input_gci.recompute_checksums()
     if not nopack:
         logger.info("Packing GCI")
         input_gci.pack()
+    else:
+        input_gci.finish_unpack()
+    input_gci.flush()
     return input_gci.raw_bytes
 
+
+async def init_async(root_mgc_path: str=None, input_gci_path: str=None, silent=False, debug=False,
+                     nopack=False, use_mmap=False, use_cache=True, checksum_all=False,
+                     max_processes: int=None) -> bytearray:
+    """Like init, for callers that run an event loop. The compile runs on a
+    worker thread, and every toolchain process is started on the event loop
+    with asyncio.create_subprocess_exec, at most max_processes at a time, so
+    the loop is never blocked waiting for the assembler. Compiles share
+    module-level state like aliases and logging settings, so concurrent
+    calls wait for each other and run one at a time."""
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(max_processes or asm.MAX_WORKERS)
+
+    async def run(args, input, pass_fds):
+        async with limit:
+            process = await asyncio.create_subprocess_exec(
+                *args, stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=pass_fds)
+            return await process.communicate(input)
+
+    def runner(args, input, pass_fds):
+        return asyncio.run_coroutine_threadsafe(run(args, input, pass_fds), loop).result()
+
+    def serialized_init():
+        with _compile_lock:
+            return init(root_mgc_path, input_gci_path, silent, debug, nopack, use_mmap, use_cache,
+                        checksum_all)
+
+    token = ppctools.runner.set(runner)
+    try:
+        return await asyncio.to_thread(serialized_init)
+    finally:
+        ppctools.runner.reset(token)
+
+
+def peek(input_gci_path: str, address: int, length: int, silent=False, debug=False) -> bytes:
+    """Reads data at a Melee memory address from a GCI, decoding only the
+    requested bytes."""
+    logger.silent_log = silent
+    logger.debug_log = debug
+    input_gci = _load_gci(input_gci_path)
+    try:
+        return input_gci.read_mem(address, length)
+    except ValueError as e:
+        raise CompileError(e.args[0])
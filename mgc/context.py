@@ -1,5 +1,6 @@
 """context.py: A class and context stack that keeps track of the current file
 and line number. Used for logging and detecting circular imports."""
+import threading
 from pathlib import Path
 
 
@@ -16,7 +17,7 @@ class Context:
         return f"{self.path.name} line {self.line_number+1}"
 
     def __enter__(self):
-        _context_stack.append(self)
+        _stack().append(self)
         return self
 
     def __exit__(self, type, value, traceback):
@@ -24,33 +25,45 @@ class Context:
         if type is not None:
             return
         # Otherwise, remove us from the top of the context stack
-        if _context_stack[-1] is not self:
+        stack = _stack()
+        if stack[-1] is not self:
             raise IndexError(f"Attempting to remove a non-top-level context: {self}")
         else:
-            _context_stack.pop()
+            stack.pop()
 
     def copy(self) -> 'Context':
         return Context(self.path, self.line_number)
 
 
 EMPTY_CONTEXT = Context(Path())
-_context_stack = [EMPTY_CONTEXT]
+# Each thread has its own stack, so a compile running on a worker thread
+# never shares it with the caller or with asm worker threads
+_local = threading.local()
+
+
+def _stack() -> list[Context]:
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = [EMPTY_CONTEXT]
+        return _local.stack
 
 
 def in_stack(path: Path) -> bool:
     """Determines whether a given path is already in the context stack."""
-    return path in [c.path for c in _context_stack]
+    return path in [c.path for c in _stack()]
 
 
 def top() -> Context:
     """Returns the top context to use for log messages."""
-    return _context_stack[-1].copy()
+    return _stack()[-1].copy()
 
 
 def root() -> Context:
     """Returns the root context."""
-    if len(_context_stack) > 1:
-        return _context_stack[1]
+    stack = _stack()
+    if len(stack) > 1:
+        return stack[1]
     else:
-        return _context_stack[0]
+        return stack[0]
 
@@ -1,10 +1,13 @@
 """files.py: Loads and builds files when sourced by the MGC script."""
 from pathlib import Path
+from typing import Iterator
 from . import logger
 from . import line
 from . import asm
+from . import parse_cache
 from .datatypes import MGCLine
 from .context import Context
+from .asm import AsmJob
 from .errors import BuildError
 
 
@@ -18,22 +21,33 @@ def bin_file(path: Path) -> bytes:
 def asm_file(path: Path) -> bytes:
     """An ASM file loaded from disk and compiled into binary."""
     logger.info(f"Reading ASM source file {path.name}")
-    data = _read_text_file(path)
+    data = list(_read_text_lines(path))
     return _build_asmfile(data)
 
 
 def gecko_file(path: Path) -> bytes:
     """A Gecko codelist file loaded from disk and compiled into binary."""
     logger.info(f"Reading Gecko codelist file {path.name}")
-    data = _read_text_file(path)
+    data = _read_text_lines(path)
     return _build_geckofile(path, data)
 
 
 def mgc_file(path: Path) -> list:
-    """An MGC file loaded from disk and parsed into a Command list."""
+    """An MGC file loaded from disk and parsed into a Command list. Parsed
+    files are kept in the build cache, unless parsing logged warnings."""
     logger.info(f"Reading MGC file {path.name}")
-    data = _read_text_file(path)
-    return _build_mgcfile(path, data)
+    digest = parse_cache.file_digest(path)
+    op_lines = parse_cache.load(digest)
+    if op_lines is not None:
+        logger.debug(f"Using cached parse of {path.name}")
+        return op_lines
+    outer_aliases = line.aliases()
+    warnings = logger.warning_count
+    used_aliases = set()
+    op_lines = _build_mgcfile(path, _read_text_lines(path), used_aliases)
+    if logger.warning_count == warnings:
+        parse_cache.store(digest, used_aliases, outer_aliases, op_lines)
+    return op_lines
 
 
 def _read_bin_file(path: Path) -> bytes:
@@ -46,16 +60,22 @@ def _read_bin_file(path: Path) -> bytes:
     return data
 
 
-def _read_text_file(path: Path) -> list[str]:
-    """Reads a text file from disk and returns a list of each line of data"""
+def _read_text_lines(path: Path) -> Iterator[str]:
+    """Opens a text file and returns an iterator over each line of data,
+    which reads the file as it goes and closes it at the end"""
     try:
-        with path.open('r') as f:
-            data = f.readlines()
+        f = path.open('r')
     except FileNotFoundError:
         raise BuildError(f"File not found: {str(path)}")
-    except UnicodeDecodeError:
-        raise BuildError("Unable to read file; make sure it's a text file")
-    return data
+    return _iter_lines(f)
+
+
+def _iter_lines(f) -> Iterator[str]:
+    with f:
+        try:
+            yield from f
+        except UnicodeDecodeError:
+            raise BuildError("Unable to read file; make sure it's a text file")
 
 
 def _build_asmfile(filedata: list[str]) -> bytes:
@@ -64,12 +84,12 @@ def _build_asmfile(filedata: list[str]) -> bytes:
     return compiled_asm
 
 
-def _build_geckofile(path: Path, data: list[str]):
+def _build_geckofile(path: Path, data: Iterator[str]):
     """Builds a file in Gecko codelist format and returns it in bytes."""
     with Context(path) as c:
         header = bytes.fromhex('00d0c0de00d0c0de')
         footer = bytes.fromhex('f000000000000000')
-        bytedata = bytes()
+        bytedata = bytearray()
         for line_number, line in enumerate(data):
             c.line_number = line_number
             if line[0] != '*':
@@ -79,56 +99,84 @@ def _build_geckofile(path: Path, data: list[str]):
                 bytedata += bytes.fromhex(line)
             except ValueError:
                 raise BuildError("Invalid Gecko code line")
-    return header + bytedata + footer
+    return header + bytes(bytedata) + footer
 
 
-def _build_mgcfile(path: Path, data: list[str]) -> list[MGCLine]:
-    """Builds an MGC script file and returns it as a list of commands."""
+def _build_mgcfile(path: Path, data: Iterator[str], used_aliases: set[str]=None) -> list[MGCLine]:
+    """Builds an MGC script file and returns it as a list of commands. Lines
+    are parsed as they're read; ASM blocks are collected along the way and
+    compiled together in the background, and their commands hold a
+    PendingAsm until they run."""
     with Context(path) as c:
-        start, end = _preprocess_begin_end(data)
-        op_lines = []
-        asm_lines = []
-        asm_cmd = ''
-        asm_args = []
-        for line_number, script_line in enumerate(data[start:end], start=start):
-            if asm_cmd:
-                if not line.is_command(script_line, asm_cmd + 'end'):
-                    asm_lines.append(script_line)
-                    continue
-                if asm_cmd == 'c2':
-                    asmdata = asm.compile_c2(asm_lines, asm_args[0])
-                else:
-                    asmdata = asm.compile_asm(asm_lines)
-                op_lines.append(MGCLine(c.line_number, asm_cmd, [asmdata]))
-                asm_cmd = ''
-                asm_args = []
-                asm_lines.clear()
-            else:
-                c.line_number = line_number
-                command, args = line.parse(script_line)
-                if not command:
-                    continue
-                if command in ['asm', 'c2']:
-                    asm_cmd = command
-                    asm_args = args
-                else:
-                    op_lines.append(MGCLine(line_number, command, args))
-        if asm_cmd:
-            raise BuildError("Command does not have an end specified")
+        script_lines = _script_lines(data, used_aliases)
+        op_lines = list(_parse_lines(script_lines, c, used_aliases))
+        asm_lines = [op for op in op_lines if op.command in ['asm', 'c2']]
+        pending = asm.submit_jobs([op.args.pop() for op in asm_lines])
+        for op, asmdata in zip(asm_lines, pending):
+            op.args.append(asmdata)
         return op_lines
 
 
-def _preprocess_begin_end(filedata):
-    """Finds the !begin and !end lines of the MGC file."""
-    start_line = 0
-    end_line = len(filedata)
-    for line_number, script_line in enumerate(filedata):
-        if line.is_command(script_line, 'begin'):
-            start_line = line_number+1
-            break
-    for line_number, script_line in enumerate(reversed(filedata)):
-        if line.is_command(script_line, 'end'):
-            end_line = len(filedata)-line_number-1
-            break
-    return start_line, end_line
-
+def _parse_lines(script_lines: Iterator[tuple[int, str]], c: Context,
+                 used_aliases: set[str]=None) -> Iterator[MGCLine]:
+    """Parses numbered MGC script lines into commands. ASM blocks become a
+    single asm or c2 command, whose last arg is the AsmJob to compile."""
+    asm_lines = []
+    asm_cmd = ''
+    asm_args = []
+    for line_number, script_line in script_lines:
+        if asm_cmd:
+            if not line.is_marker(script_line, asm_cmd + 'end', used_aliases):
+                asm_lines.append(script_line)
+                continue
+            c2_ba = asm_args[0] if asm_cmd == 'c2' else None
+            yield MGCLine(c.line_number, asm_cmd, [AsmJob(asm_lines, c2_ba, c.copy())])
+            asm_cmd = ''
+            asm_args = []
+            asm_lines = []
+        else:
+            c.line_number = line_number
+            command, args = line.parse(script_line, used_aliases=used_aliases)
+            if not command:
+                continue
+            if command in ['asm', 'c2']:
+                asm_cmd = command
+                asm_args = args
+            else:
+                yield MGCLine(line_number, command, args)
+    if asm_cmd:
+        raise BuildError("Command does not have an end specified")
+
+
+def _script_lines(data: Iterator[str], used_aliases: set[str]=None) -> Iterator[tuple[int, str]]:
+    """Yields the numbered lines of an MGC file between its first !begin and
+    its last !end. Lines before a !begin are held until one is found, or the
+    file ends without one; lines after an !end are held until another !end
+    is found, since either could turn out to be the boundary."""
+    numbered = enumerate(data)
+    held = []
+    for line_number, script_line in numbered:
+        if line.is_marker(script_line, 'begin', used_aliases):
+            # An !end before the !begin ends the script, unless there's
+            # another one after it
+            ended = any(line.is_marker(l, 'end', used_aliases) for _, l in held)
+            yield from _until_end(numbered, ended, used_aliases)
+            return
+        held.append((line_number, script_line))
+    yield from _until_end(iter(held), False, used_aliases)
+
+
+def _until_end(numbered: Iterator[tuple[int, str]], ended: bool,
+               used_aliases: set[str]=None) -> Iterator[tuple[int, str]]:
+    """Yields numbered lines up to the last !end, or all of them if there
+    isn't one and ended is False."""
+    held = []
+    for numbered_line in numbered:
+        if line.is_marker(numbered_line[1], 'end', used_aliases):
+            yield from held
+            held = [numbered_line]
+            ended = True
+        elif ended:
+            held.append(numbered_line)
+        else:
+            yield numbered_line
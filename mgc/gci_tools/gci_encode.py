@@ -1,8 +1,21 @@
 #!usr/bin/env python
 """gci_encode.py: Encodes and decodes bytes in a Melee GCI file."""
 
+from pathlib import Path
 from .ppc_opcodes import *
 
+# NumPy is optional; when it's available, whole blocks are decoded at once
+# and large batches of blocks are encoded side by side
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+TABLE_PATH = Path(__file__).parent/"gci_tables.bin"
+TABLE_SIZE = 0x10000
+# Below this many runs, stepping NumPy arrays costs more than plain lookups
+MIN_NUMPY_ENCODE_RUNS = 32
+
 CHECKSUM_SEED = bytes([
     0x01, 0x23, 0x45, 0x67, 0x89, 0xAB, 0xCD, 0xEF,
     0xFE, 0xDC, 0xBA, 0x98, 0x76, 0x54, 0x32, 0x10
@@ -236,3 +249,99 @@ def encode_byte(prev_byte: int, current_byte: int) -> int:
             r0 = rlwimi(r0, r3, 30, 26, 26);
             r3 = rlwinm(r0, 0, 24, 31);
     return r3
+
+
+def build_tables() -> tuple[bytes, bytes]:
+    """Generates the encode and decode tables using encode_byte and
+    decode_byte as the reference implementation. Each table is indexed by
+    (prev_byte << 8) | current_byte."""
+    encode_table = bytes(encode_byte(p, c) for p in range(256) for c in range(256))
+    decode_table = bytes(decode_byte(p, c) for p in range(256) for c in range(256))
+    return encode_table, decode_table
+
+
+def write_tables(path: Path=TABLE_PATH) -> None:
+    """Regenerates the precomputed table file shipped alongside this module."""
+    encode_table, decode_table = build_tables()
+    with open(path, 'wb') as f:
+        f.write(encode_table + decode_table)
+
+
+def _load_tables() -> tuple[bytes, bytes]:
+    """Loads the precomputed encode and decode tables, falling back to
+    generating them if the table file is missing or damaged."""
+    try:
+        with open(TABLE_PATH, 'rb') as f:
+            data = f.read()
+    except OSError:
+        data = b''
+    if len(data) != TABLE_SIZE * 2:
+        return build_tables()
+    return data[:TABLE_SIZE], data[TABLE_SIZE:]
+
+
+ENCODE_TABLE, DECODE_TABLE = _load_tables()
+if np is not None:
+    DECODE_ARRAY = np.frombuffer(DECODE_TABLE, dtype=np.uint8)
+    ENCODE_ARRAY = np.frombuffer(ENCODE_TABLE, dtype=np.uint8).reshape(256, 256)
+
+
+def decode_bytes(prev_byte: int, data: bytes) -> bytes:
+    """Decodes a run of bytes from an encoded GCI, given the encoded byte that
+    precedes the run."""
+    table = DECODE_TABLE
+    prevs = bytes([prev_byte]) + data[:-1]
+    return bytes([table[p << 8 | c] for p, c in zip(prevs, data)])
+
+
+def encode_bytes(prev_byte: int, data: bytes) -> bytes:
+    """Encodes a run of bytes from a decoded GCI, given the encoded byte that
+    precedes the run."""
+    table = ENCODE_TABLE
+    out = bytearray(len(data))
+    for i, c in enumerate(data):
+        prev_byte = table[prev_byte << 8 | c]
+        out[i] = prev_byte
+    return bytes(out)
+
+
+def decode_runs(data: bytearray, offsets: list[int], size: int) -> None:
+    """Decodes equal-sized runs of an encoded GCI in place. Each run starts at
+    one of the given offsets and is preceded by its encoded prev byte. Uses
+    NumPy to decode every run in one batch if it's installed."""
+    if np is None:
+        for offset in offsets:
+            prev = data[offset-1]
+            data[offset:offset+size] = decode_bytes(prev, data[offset:offset+size])
+        return
+    # Decoding only depends on encoded bytes, so every byte can be looked up
+    # at once from the (prev, current) pairs
+    index = np.asarray(offsets)[:, None] + np.arange(-1, size)
+    runs = np.frombuffer(data, dtype=np.uint8)[index].astype(np.uint16)
+    decoded = DECODE_ARRAY[(runs[:, :-1] << 8) | runs[:, 1:]]
+    for offset, run in zip(offsets, decoded):
+        data[offset:offset+size] = run.tobytes()
+
+
+def encode_runs(runs: list[tuple[bytearray, int]], size: int) -> None:
+    """Encodes equal-sized runs of decoded GCI data in place. Each run is a
+    buffer and the offset it starts at, and is preceded by its already-encoded
+    prev byte. Encoding is serial within a run, but runs are independent, so
+    with NumPy all runs are stepped through together one byte position at a
+    time."""
+    if np is None or len(runs) < MIN_NUMPY_ENCODE_RUNS:
+        for data, offset in runs:
+            prev = data[offset-1]
+            data[offset:offset+size] = encode_bytes(prev, data[offset:offset+size])
+        return
+    prev = np.array([data[offset-1] for data, offset in runs], dtype=np.uint8)
+    plain = np.empty((size, len(runs)), dtype=np.uint8)
+    for lane, (data, offset) in enumerate(runs):
+        plain[:, lane] = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset)
+    encoded = np.empty_like(plain)
+    for i in range(size):
+        prev = ENCODE_ARRAY[prev, plain[i]]
+        encoded[i] = prev
+    encoded = encoded.T.copy()
+    for (data, offset), run in zip(runs, encoded):
+        data[offset:offset+size] = run.tobytes()
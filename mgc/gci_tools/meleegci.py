@@ -1,21 +1,31 @@
 """ meleegci.py - interfaces for manipulating Melee savefiles """
 
 import struct
+import mmap
 
-from .gci_encode import decode_byte as unpack
-from .gci_encode import encode_byte as pack
+from .gci_encode import decode_runs
+from .gci_encode import encode_runs
+from .gci_encode import encode_bytes
+from .gci_encode import decode_bytes
+from .mem2gci import data2gci
 from .. import logger
 
 class melee_gci(object):
     """ Base class for GCI files. Just basic setter/getter stuff for dentry
         data, and some machinery for reading files """
 
-    def __init__(self, filename=None, raw_bytes=None, packed=None):
+    def __init__(self, filename=None, raw_bytes=None, packed=None, use_mmap=False):
         if filename:
             self.raw_bytes = bytearray()
             try:
-                with open(filename, "rb") as fd:
-                    self.raw_bytes = bytearray(fd.read())
+                # A memory map lets every operation work on the file in place,
+                # so only the pages that change get written back
+                if use_mmap:
+                    with open(filename, "r+b") as fd:
+                        self.raw_bytes = mmap.mmap(fd.fileno(), 0)
+                else:
+                    with open(filename, "rb") as fd:
+                        self.raw_bytes = bytearray(fd.read())
                 self.filesize = len(self.raw_bytes)
                 self.packed = packed
                 logger.debug("Read {} bytes from input GCI".format(hex(self.filesize)))
@@ -43,6 +53,15 @@ class melee_gci(object):
 
     def dump(self):
         return self.raw_bytes
+    def flush(self):
+        """ Write changes back to the file if it was opened with use_mmap """
+        if isinstance(self.raw_bytes, mmap.mmap):
+            self.raw_bytes.flush()
+    def close(self):
+        """ Flush and unmap the file if it was opened with use_mmap """
+        if isinstance(self.raw_bytes, mmap.mmap):
+            self.raw_bytes.flush()
+            self.raw_bytes.close()
     def get_dentry(self):
         return self.raw_bytes[0:0x40]
     def get_game_id(self):
@@ -83,6 +102,25 @@ class melee_gci(object):
         """ Given some offset into raw_bytes and a count, compute checksum
             over the set of bytes in the GCI """
 
+        # Checksum slot j is the seed plus every 16th byte starting at j, so
+        # each slot can be summed with a single strided slice. Bytes are
+        # consumed 8 at a time, so a partial group still counts in full.
+        new_checksum = bytearray( b'\x01\x23\x45\x67\x89\xAB\xCD\xEF' +
+                                  b'\xFE\xDC\xBA\x98\x76\x54\x32\x10' )
+        count = -(-count // 8) * 8
+        data = memoryview(self.raw_bytes)[target_offset:target_offset + count]
+        for j in range(0, 0x10):
+            new_checksum[j] = (new_checksum[j] + sum(data[j::0x10])) & 0xff
+        data.release()
+        for i in range(1, 0xf):
+            if (new_checksum[i-1] == new_checksum[i]):
+                new_checksum[i] = new_checksum[i] ^ 0x00FF
+        return new_checksum
+
+    def _checksum_reference(self, target_offset, count):
+        """ Byte-at-a-time version of _checksum, kept as the reference
+            implementation """
+
         # This is the seed for all checksum values
         new_checksum = bytearray( b'\x01\x23\x45\x67\x89\xAB\xCD\xEF' +
                                   b'\xFE\xDC\xBA\x98\x76\x54\x32\x10' )
@@ -113,6 +151,61 @@ class melee_gamedata(melee_gci):
         The checksum/packing functions here are specific to the format,
         so you'll need another class for other types of save files. '''
 
+    def __init__(self, filename=None, raw_bytes=None, packed=None, use_mmap=False):
+        super().__init__(filename, raw_bytes, packed, use_mmap)
+        # Blocks known to have changed since the GCI was unpacked. Changes
+        # made straight to raw_bytes are found by comparing each block with
+        # its cached plaintext, so this is only a hint; blocks that are
+        # neither in it nor changed reuse the ciphertext saved when unpacking.
+        self.dirty_blocks = set(range(0, 10))
+        # Plaintext and ciphertext of each block as of the last time it was
+        # decoded or packed. Since every encoded byte only depends on the
+        # previous encoded byte, a block can resume encoding from the first
+        # byte that differs from the cached plaintext.
+        self._pack_cache = {}
+        # Blocks that were lazily unpacked and still hold ciphertext
+        self._encoded_blocks = set()
+
+    def _blocks_in_range(self, address, end):
+        """ Return the block numbers that overlap raw_bytes[address:end] """
+        first = max(address - 0x2040, 0) // 0x2000
+        last = (end - 1 - 0x2040) // 0x2000
+        return range(first, min(last, 9) + 1)
+
+    def write(self, address, data):
+        """ Write data to raw_bytes at some offset, and mark any blocks whose
+            contents actually changed as dirty """
+        end = address + len(data)
+        blocks = self._blocks_in_range(address, end)
+        self._decode_blocks(blocks)
+        if (self.raw_bytes[address:end] == data):
+            return
+        self.raw_bytes[address:end] = data
+        for blknum in blocks:
+            self.dirty_blocks.add(blknum)
+
+    def read(self, address, length):
+        """ Read decoded bytes from raw_bytes at some offset. If the data is
+            still packed, only the requested bytes get decoded. """
+        end = address + length
+        data = bytearray(self.raw_bytes[address:end])
+        for blknum in self._blocks_in_range(address, end):
+            if (self.packed is not True) and (blknum not in self._encoded_blocks):
+                continue
+            start = max(address, 0x2000 * blknum + 0x2050)
+            stop = min(end, 0x2000 * blknum + 0x4040)
+            if (start >= stop):
+                continue
+            decoded = decode_bytes(self.raw_bytes[start-1], self.raw_bytes[start:stop])
+            data[(start - address):(stop - address)] = decoded
+        return bytes(data)
+
+    def read_mem(self, address, length):
+        """ Read decoded bytes from the GCI locations that map to some Melee
+            memory address """
+        spans = data2gci(address, bytes(length))
+        return b''.join(self.read(offset, len(span)) for offset, span in spans)
+
     def get_raw_checksum(self, blknum):
         """ Return checksum bytes for some block 0-10 """
         base_offset = 0x2040
@@ -140,29 +233,53 @@ class melee_gamedata(melee_gci):
         data_size = 0x1ff0
         if (blknum >= 0) and (blknum <= (self.blocksize() - 1)):
             target_offset = base_offset + (blknum * 0x2000)
+            self._decode_blocks([blknum])
             return self._checksum(target_offset, data_size)
         else:
             raise Exception("Can't compute checksum bytes for block {}".format(blknum))
 
 
+    def mark_all_dirty(self):
+        """ Mark every block as changed, so the next recompute_checksums()
+            checksums all of them and repairs any bad checksums """
+        self.dirty_blocks = set(range(0, 10))
+
+    def _changed_blocks(self):
+        """ Return the blocks that are marked dirty, or that were decoded and
+            no longer match the plaintext they were decoded or packed with """
+        changed = set(self.dirty_blocks)
+        for i in range(0, self.blocksize()-1):
+            if (i in self._encoded_blocks) or (i in changed):
+                continue
+            base = 0x2000 * i + 0x2050
+            cached = self._pack_cache.get(i)
+            if (not cached) or (cached[0] is None) or \
+               (cached[0][0x10:] != self.raw_bytes[base:(base + 0x1ff0)]):
+                changed.add(i)
+        return changed
+
     def recompute_checksums(self):
-        """ Recompute all checksum values and write them back """
+        """ Recompute checksum values for all changed blocks and write them
+            back. Unchanged blocks still hold the checksum they were unpacked
+            with, unless mark_all_dirty() was called. """
         if (self.packed is True):
             raise Exception("You can only recompute checksums on unpacked data")
 
+        changed = self._changed_blocks()
+        blocks = [i for i in range(0, self.blocksize()-1) if i in changed]
 
-        # Retrieve checksum values for all blocks
-        current = []
-        for i in range(0, self.blocksize()-1):
-            current.append(self.get_raw_checksum(i))
+        # Retrieve checksum values for dirty blocks
+        current = {}
+        for i in blocks:
+            current[i] = self.get_raw_checksum(i)
 
-        # Compute checksum values for all blocks
-        computed = []
-        for i in range(0, self.blocksize()-1):
-            computed.append(self.checksum_block(i))
+        # Compute checksum values for dirty blocks
+        computed = {}
+        for i in blocks:
+            computed[i] = self.checksum_block(i)
 
         # If current checksums don't match, write them back
-        for i in range(0, self.blocksize()-1):
+        for i in blocks:
             if (current[i] != computed[i]):
                 logger.debug("Block {} checksum mismatch, fixing ..".format(i))
                 self.set_raw_checksum(i, computed[i])
@@ -174,6 +291,7 @@ class melee_gamedata(melee_gci):
         if (blknum > 10):
             return None
         base = 0x2000 * blknum + 0x2060
+        self._decode_blocks([blknum])
         return self.raw_bytes[base:(base + 0x1fe0)]
 
     def set_block(self, blknum, data):
@@ -181,7 +299,7 @@ class melee_gamedata(melee_gci):
         if (blknum > 10):
             return None
         base = 0x2000 * blknum + 0x2060
-        self.raw_bytes[base:(base + 0x1fe0)] = data
+        self.write(base, data)
 
     def reorder_blocks(self):
         ''' Reorder the blocks according to block_order '''
@@ -191,27 +309,116 @@ class melee_gamedata(melee_gci):
             newbase = 0x2000 * index + 0x2040
             new_bytes[newbase:(newbase + 0x2000)] = self.raw_bytes[base:(base + 0x2000)]
         self.raw_bytes[0x2040:] = new_bytes[0x2040:]
-    def unpack(self):
-        """ Unpack all blocks of data """
+        # A block's ciphertext only depends on its own checksum and data, so
+        # the saved ciphertext and dirty state move along with each block
+        self.dirty_blocks = {index for index, blknum in enumerate(self.block_order)
+                             if blknum in self.dirty_blocks}
+        self._pack_cache = {index: self._pack_cache[blknum]
+                            for index, blknum in enumerate(self.block_order)
+                            if blknum in self._pack_cache}
+        self._encoded_blocks = {index for index, blknum in enumerate(self.block_order)
+                                if blknum in self._encoded_blocks}
+
+    def unpack(self, lazy=False):
+        """ Unpack all blocks of data. If lazy is set, blocks keep their
+            ciphertext until they're first read or written, and blocks that
+            are never touched can be copied straight back out by pack() """
         if (self.packed is False):
             raise Exception("Data is already unpacked - refusing to unpack")
 
         logger.debug("Unpacking GCI data")
 
-        PREV_BYTE_OFFSET = 0x204f
-        BASE_OFFSET = 0x2050
-        DATA_SIZE = 0x1ff0
-        for _ in range(0, self.blocksize()-1):
-            prev = self.raw_bytes[PREV_BYTE_OFFSET]
-            for i in range(BASE_OFFSET, BASE_OFFSET + DATA_SIZE):
-                cursor = self.raw_bytes[i]
-                res = unpack(prev, cursor)
-                self.raw_bytes[i] = res
-                prev = cursor
-            PREV_BYTE_OFFSET += 0x2000
-            BASE_OFFSET += 0x2000
+        self._encoded_blocks = set(range(0, self.blocksize()-1))
+        self.dirty_blocks.clear()
         if (self.packed is True):
             self.packed = False
+        if not lazy:
+            self.finish_unpack()
+
+    def finish_unpack(self):
+        """ Decode any blocks that are still encoded after a lazy unpack """
+        self._decode_blocks(range(0, self.blocksize()-1))
+
+    def _decode_blocks(self, blocks):
+        """ Decode the given blocks if they still hold ciphertext, saving the
+            ciphertext so pack() can reuse it while the block is clean """
+        blocks = [i for i in blocks if i in self._encoded_blocks]
+        if not blocks:
+            return
+        BASE_OFFSET = 0x2050
+        DATA_SIZE = 0x1ff0
+        to_decode = []
+        for i in blocks:
+            base = 0x2000 * i + 0x2040
+            self._encoded_blocks.discard(i)
+            ciphertext = bytes(self.raw_bytes[base:(base + 0x2000)])
+            cached = self._pack_cache.get(i)
+            if cached and (cached[1] == ciphertext):
+                # Unchanged since we last packed it, so skip decoding
+                self.raw_bytes[base:(base + 0x2000)] = cached[0]
+            else:
+                self._pack_cache[i] = (None, ciphertext)
+                to_decode.append(i)
+        if not to_decode:
+            return
+        logger.debug("Decoding {} blocks".format(len(to_decode)))
+        offsets = [BASE_OFFSET + (i * 0x2000) for i in to_decode]
+        decode_runs(self.raw_bytes, offsets, DATA_SIZE)
+        for i in to_decode:
+            base = 0x2000 * i + 0x2040
+            self._pack_cache[i] = (bytes(self.raw_bytes[base:(base + 0x2000)]),
+                                   self._pack_cache[i][1])
+
+    def _pack_runs(self):
+        """ Restore cached ciphertext for every block up to its first changed
+            byte, and return the runs of blocks that need to be encoded from
+            the start. Blocks that only changed partway through are finished
+            here, since the rest of the block is usually short. """
+        DATA_SIZE = 0x1ff0
+        runs = []
+        resumed = 0
+        for i in range(0, self.blocksize()-1):
+            if (i in self._encoded_blocks):
+                continue
+            base = 0x2000 * i + 0x2040
+            plaintext = bytes(self.raw_bytes[base:(base + 0x2000)])
+            cached = self._pack_cache.get(i)
+            self._pack_cache[i] = (plaintext, None)
+            if not cached or (cached[0] is None):
+                runs.append((self.raw_bytes, base + 0x10))
+                continue
+            if (plaintext == cached[0]):
+                start = DATA_SIZE
+            elif (plaintext[0xf] != cached[0][0xf]):
+                # The byte before the data changed, so nothing can be reused
+                start = 0
+            else:
+                start = _first_difference(plaintext[0x10:], cached[0][0x10:])
+            if (start == 0):
+                runs.append((self.raw_bytes, base + 0x10))
+                continue
+            ciphertext = cached[1]
+            data_base = base + 0x10
+            self.raw_bytes[data_base:(data_base + start)] = ciphertext[0x10:(0x10 + start)]
+            if (start < DATA_SIZE):
+                resumed += 1
+                self.raw_bytes[(data_base + start):(data_base + DATA_SIZE)] = encode_bytes(
+                    ciphertext[0xf + start], plaintext[(0x10 + start):])
+        logger.debug("Encoding {} dirty blocks ({} resumed partway)".format(
+            len(runs) + resumed, resumed))
+        return runs
+
+    def _mark_packed(self):
+        """ Reset dirty tracking once raw_bytes holds packed data, and cache
+            the ciphertext of every block that was just packed """
+        for i, (plaintext, ciphertext) in list(self._pack_cache.items()):
+            if (ciphertext is None):
+                base = 0x2000 * i + 0x2040
+                self._pack_cache[i] = (plaintext, bytes(self.raw_bytes[base:(base + 0x2000)]))
+        self._encoded_blocks.clear()
+        self.dirty_blocks = set(range(0, 10))
+        if (self.packed is False):
+            self.packed = True
 
     def pack(self):
         """ Pack all blocks of data """
@@ -220,18 +427,35 @@ class melee_gamedata(melee_gci):
 
         logger.debug("Packing GCI data")
 
-        PREV_BYTE_OFFSET = 0x204f
-        BASE_OFFSET = 0x2050
         DATA_SIZE = 0x1ff0
-        for _ in range(0, self.blocksize()-1):
-            prev = self.raw_bytes[PREV_BYTE_OFFSET]
-            for i in range(BASE_OFFSET, BASE_OFFSET + DATA_SIZE):
-                cursor = self.raw_bytes[i]
-                res = pack(prev, cursor)
-                self.raw_bytes[i] = res
-                prev = res
-            PREV_BYTE_OFFSET += 0x2000
-            BASE_OFFSET += 0x2000
-        if (self.packed is False):
-            self.packed = True
+        encode_runs(self._pack_runs(), DATA_SIZE)
+        self._mark_packed()
+
+def pack_batch(gcis):
+    """ Pack all blocks of several gamedata objects at once. Blocks are
+        independent of each other, so every block of every GCI is encoded
+        as its own lane in a single pass """
+    for gci in gcis:
+        if (gci.packed is True):
+            raise Exception("Data is already packed -- refusing to pack")
+
+    logger.debug("Packing {} GCIs".format(len(gcis)))
+
+    DATA_SIZE = 0x1ff0
+    runs = []
+    for gci in gcis:
+        runs += gci._pack_runs()
+    encode_runs(runs, DATA_SIZE)
+    for gci in gcis:
+        gci._mark_packed()
 
+def _first_difference(a, b):
+    """ Return the index of the first byte where a and b differ, or their
+        length if they're the same """
+    length = min(len(a), len(b))
+    pos = 0
+    while (pos < length) and (a[pos:pos + 0x100] == b[pos:pos + 0x100]):
+        pos += 0x100
+    while (pos < length) and (a[pos] == b[pos]):
+        pos += 1
+    return min(pos, length)
@@ -1,42 +1,166 @@
 #!/usr/bin/python3
-""" savefile - example script for [un]packing a save file. """
+""" savefile - batch [un]packing and checksum repair for Melee save files.
+    Run with python -m mgc.gci_tools.savefile """
 
 import sys
+import os
+import glob
+import getopt
+import time
+import shutil
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from .meleegci import *
+from .meleegci import melee_gamedata, pack_batch
 
-print(sys.argv)
-if len(sys.argv) < 4:
-    print("Usage: savefile.py [--pack | --unpack] <input GCI> <output GCI>")
-    print("[Un]pack the input GCI and save the contents to some output file.")
-    exit(0)
-else:
-    flag = sys.argv[1]
-    input_fn = sys.argv[2]
-    output_fn = sys.argv[3]
+USAGE_TEXT = """\
+Usage: savefile.py [--pack | --unpack | --checksum] [-j jobs] [--mmap] -o <output dir> <input>...
 
-# -----------------------------------------------------------------------------
+--unpack       Unpack each packed input GCI.
+--pack         Recompute checksums and pack each unpacked input GCI.
+--checksum     Recompute checksums of each packed input GCI and repack it.
+-o             The directory to write output GCIs to, using the same filenames.
+-j             How many processes to use (defaults to the number of CPUs).
+--mmap         Copy each input to the output directory and convert it in place
+               through a memory map, instead of reading and writing it whole.
 
-if (flag == "--unpack"):
-    input_gci = melee_gamedata(input_fn, packed=True)
-    print("[*] Read GCI: {}".format(input_gci.get_filename()))
-    input_gci.unpack()
+Inputs can be GCI files, directories containing GCI files, or glob patterns.
+"""
 
-elif (flag == "--pack"):
-    input_gci = melee_gamedata(input_fn, packed=False)
-    print("[*] Read GCI: {}".format(input_gci.get_filename()))
-    input_gci.recompute_checksums()
-    input_gci.pack()
+GCI_SIZE = 0x16040
+# Files handled per task; packing encodes every block of a task side by side
+CHUNK_SIZE = 16
 
-else:
-    print("Usage: savefile.py [--pack | --unpack] <input GCI> <output GCI>")
-    exit(0)
 
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'o:j:h', ['help', 'pack', 'unpack', 'checksum', 'mmap'])
+    except getopt.GetoptError:
+        return 2
+    mode = None
+    output_dir = None
+    jobs = os.cpu_count() or 1
+    use_mmap = False
+    for opt, arg in opts:
+        match opt:
+            case '-h'|'--help':
+                print(USAGE_TEXT)
+                return 0
+            case '--pack'|'--unpack'|'--checksum':
+                if mode:
+                    return 2
+                mode = opt[2:]
+            case '-o': output_dir = Path(arg)
+            case '--mmap': use_mmap = True
+            case '-j':
+                try:
+                    jobs = max(int(arg), 1)
+                except ValueError:
+                    return 2
+    if not mode or not output_dir or not args:
+        return 2
+    paths = _find_inputs(args)
+    if not paths:
+        print("[!] No input GCIs found")
+        return 1
+    names = [p.name for p in paths]
+    if len(set(names)) != len(names):
+        print("[!] Input GCIs must have unique filenames")
+        return 1
+    output_dir.mkdir(parents=True, exist_ok=True)
+    return _run(mode, paths, output_dir, jobs, use_mmap)
 
-# -----------------------------------------------------------------------------
-# Write the new GCI to a file
 
-print("Writing to {}".format(output_fn))
-ofd = open(output_fn, "wb")
-ofd.write(input_gci.raw_bytes)
-ofd.close()
+def _find_inputs(args):
+    """ Expand directories and glob patterns into a list of GCI paths """
+    paths = []
+    for arg in args:
+        if os.path.isdir(arg):
+            paths += sorted(Path(arg).glob('*.gci'))
+        else:
+            paths += [Path(p) for p in sorted(glob.glob(arg)) if os.path.isfile(p)]
+    return list(dict.fromkeys(paths))
+
+
+def _run(mode, paths, output_dir, jobs, use_mmap):
+    """ Process every input across a process pool and print a summary """
+    chunks = [paths[i:i + CHUNK_SIZE] for i in range(0, len(paths), CHUNK_SIZE)]
+    start = time.perf_counter()
+    done = 0
+    failed = 0
+    pool = None
+    if jobs > 1 and len(chunks) > 1:
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        futures = [pool.submit(_process_chunk, mode, chunk, output_dir, use_mmap) for chunk in chunks]
+        results = (r for f in as_completed(futures) for r in f.result())
+    else:
+        results = (r for chunk in chunks for r in _process_chunk(mode, chunk, output_dir, use_mmap))
+    try:
+        for path, error in results:
+            if error:
+                failed += 1
+                print("[!] {}: {}".format(path, error))
+            else:
+                done += 1
+    finally:
+        if pool:
+            pool.shutdown()
+    elapsed = time.perf_counter() - start
+    size = done * GCI_SIZE / 0x100000
+    print("[*] {} {} files ({:.1f} MiB) in {:.2f}s: {:.1f} files/s, {:.1f} MiB/s".format(
+        mode, done, size, elapsed, done / elapsed, size / elapsed))
+    if failed:
+        print("[!] {} files failed".format(failed))
+        return 1
+    return 0
+
+
+def _process_chunk(mode, paths, output_dir, use_mmap=False):
+    """ Load, convert and write a chunk of GCIs. Returns (path, error) for
+        each input, where error is None on success. """
+    results = {}
+    gcis = {}
+    for path in paths:
+        try:
+            if os.path.getsize(path) != GCI_SIZE:
+                results[path] = "Wrong size; make sure it's a Melee save file"
+                continue
+            if use_mmap:
+                shutil.copyfile(path, output_dir/path.name)
+                gci = melee_gamedata(filename=output_dir/path.name,
+                                     packed=(mode != 'pack'), use_mmap=True)
+            else:
+                gci = melee_gamedata(filename=path, packed=(mode != 'pack'))
+        except OSError as e:
+            results[path] = str(e)
+            continue
+        gcis[path] = gci
+    if mode == 'unpack':
+        for gci in gcis.values():
+            gci.unpack()
+    else:
+        if mode == 'checksum':
+            for gci in gcis.values():
+                gci.unpack(lazy=True)
+                gci.mark_all_dirty()
+        for gci in gcis.values():
+            gci.recompute_checksums()
+        pack_batch(list(gcis.values()))
+    for path, gci in gcis.items():
+        try:
+            if use_mmap:
+                gci.close()
+            else:
+                with open(output_dir/path.name, 'wb') as f:
+                    f.write(gci.raw_bytes)
+            results[path] = None
+        except OSError as e:
+            results[path] = str(e)
+    return [(str(path), results[path]) for path in paths]
+
+
+if __name__ == "__main__":
+    r = main(sys.argv)
+    if r == 2:
+        print(USAGE_TEXT)
+    sys.exit(r)
@@ -1,7 +1,6 @@
 """line.py: Parses a line of MGC script into a Command."""
 import string
 import re
-import shlex
 from .type_validator import validate
 from . import logger
 from .errors import BuildError
@@ -9,11 +8,19 @@ from .errors import BuildError
 
 _aliases: dict[str, str] = {}
 _NOP = ('', [])
+# Splits a line into tokens the same way shlex.split(posix=False) does:
+# quoted strings keep their quotes and end at the closing quote, quotes
+# inside other tokens are literal, and a lone quote was never closed
+_TOKEN = re.compile(r'"[^"]*"|\'[^\']*\'|["\']|[^ \t\r\n"\'][^ \t\r\n]*')
+_BRACKETS = re.compile(r'\[.*\]')
+_ALIAS = re.compile(r'\[[^\[\]]*\]')
 
-def parse(line: str, desired_command: str='') -> tuple[str, list]:
-    """Parses the MGC script line string into a command and arguments."""
-    line = line.split('#')[0]
-    line = _replace_aliases(line, not desired_command)
+def parse(line: str, desired_command: str='', used_aliases: set[str]=None) -> tuple[str, list]:
+    """Parses the MGC script line string into a command and arguments. If
+    used_aliases is given, the name of each alias the line refers to is added
+    to it, whether or not it's defined."""
+    line = line.partition('#')[0]
+    line = _replace_aliases(line, not desired_command, used_aliases)
     line = line.strip()
     if not line:
         return _NOP
@@ -29,29 +36,69 @@ def parse(line: str, desired_command: str='') -> tuple[str, list]:
         if len(args) == 1:
             args.append('1')
     else:
-        args = shlex.split(line, posix=False)[1:]
+        args = _tokenize(line)[1:]
     typed_args = validate(cmdname, args)
     if cmdname == 'define':
-        _add_alias(typed_args[0], typed_args[1])
+        add_alias(typed_args[0], typed_args[1])
         return _NOP
     return cmdname, typed_args
 
 
-def is_command(line: str, desired_command: str) -> bool:
+def is_marker(line: str, desired_command: str, used_aliases: set[str]=None) -> bool:
+    """A cheaper is_command for structural commands like !begin and !asmend,
+    which looks at the first token only. Lines that use aliases or have
+    more tokens still get a full parse, so they behave the same."""
+    code = line.partition('#')[0]
+    if '[' in code:
+        return is_command(line, desired_command, used_aliases)
+    tokens = code.split(None, 1)
+    if not tokens or tokens[0] != '!' + desired_command:
+        return False
+    if len(tokens) > 1:
+        return is_command(line, desired_command, used_aliases)
+    return True
+
+
+def _tokenize(line: str) -> list[str]:
+    """Splits a line into its command and argument tokens."""
+    tokens = _TOKEN.findall(line)
+    for token in tokens:
+        if token == '"' or token == "'":
+            raise BuildError("No closing quotation")
+    return tokens
+
+
+def is_command(line: str, desired_command: str, used_aliases: set[str]=None) -> bool:
     """Checks if the given line contains the desired command."""
-    return parse(line, desired_command) is not _NOP
+    return parse(line, desired_command, used_aliases) is not _NOP
 
 
-def _replace_aliases(line: str, warn: bool=True) -> str:
-    """Replaces aliases with their defined values during parse."""
-    for key, value in _aliases.items():
-        line = line.replace(key, value)
-    if warn and re.search(r'\[.*\]', line):
+def _replace_aliases(line: str, warn: bool=True, used_aliases: set[str]=None) -> str:
+    """Replaces aliases with their defined values during parse, in a single
+    pass; values are inserted as-is and not scanned for more aliases."""
+    if '[' not in line:
+        return line
+
+    def expand(m: re.Match) -> str:
+        if used_aliases is not None:
+            used_aliases.add(m.group(0)[1:-1])
+        value = _aliases.get(m.group(0))
+        if value is None:
+            return m.group(0)
+        return value
+
+    line = _ALIAS.sub(expand, line)
+    if warn and _BRACKETS.search(line):
         logger.warning("No matching alias, taking brackets literally")
     return line
 
 
-def _add_alias(name: str, value: str) -> None:
+def aliases() -> dict[str, str]:
+    """Returns a copy of the defined aliases, keyed by name."""
+    return {key[1:-1]: value for key, value in _aliases.items()}
+
+
+def add_alias(name: str, value: str) -> None:
     """Adds a new alias during parse if the parsed command is !define."""
     name = '[' + name + ']'
     if name in _aliases:
@@ -6,6 +6,9 @@ from . import context
 MAX_FILE_STRING_LENGTH = 30
 silent_log = False
 debug_log = False
+# How many warnings have been logged, so callers can tell if an operation
+# produced any
+warning_count = 0
 
 
 def debug(message: str, line_number: int=None) -> None:
@@ -17,6 +20,8 @@ def info(message: str, line_number: int=None) -> None:
 
 
 def warning(message: str, line_number: int=None) -> None:
+    global warning_count
+    warning_count += 1
     _log('WARNING', message, line_number)
 
 
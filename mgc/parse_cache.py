@@ -0,0 +1,111 @@
+"""parse_cache.py: Keeps parsed MGC files in the build cache, so unchanged
+files don't need to be parsed or have their ASM compiled again. A parse
+depends on the file's content and on the aliases defined before it, so each
+file has an index entry listing the aliases it uses, and one entry per set
+of values those aliases had."""
+import marshal
+import hashlib
+from pathlib import Path
+from . import asm_cache
+from . import line
+from . import asm
+from .datatypes import MGCLine
+
+
+# Bump when the layout of cached entries changes
+FORMAT_VERSION = 1
+_source_hash: str = None
+
+
+def _compiler_hash() -> str:
+    """Hashes the source of the whole mgc package, including the assemblers
+    that produced the cached ASM, so entries written by a different version
+    are never used."""
+    global _source_hash
+    if _source_hash is None:
+        h = hashlib.sha256(str(FORMAT_VERSION).encode())
+        for path in sorted(Path(__file__).parent.glob('**/*.py')):
+            h.update(path.read_bytes())
+        _source_hash = h.hexdigest()
+    return _source_hash
+
+
+def file_digest(path: Path) -> str:
+    """Hashes the content of an MGC file, reading it in chunks, or returns
+    None if caching is off or the file can't be read."""
+    if not asm_cache.enabled:
+        return None
+    h = hashlib.sha256()
+    try:
+        with path.open('rb') as f:
+            while chunk := f.read(1 << 16):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def _index_key(digest: str) -> str:
+    if not digest:
+        return None
+    return asm_cache.key('mgc-aliases', _compiler_hash(), digest)
+
+
+def _entry_key(digest: str, used: list[str], aliases: dict[str, str]) -> str:
+    values = repr([(name, aliases.get(name)) for name in used])
+    return asm_cache.key('mgc', _compiler_hash(), digest, values)
+
+
+def load(digest: str) -> list[MGCLine]:
+    """Returns the cached parse of an MGC file, given its file_digest, with
+    the aliases currently defined, replaying the aliases it defines, or None
+    on a cache miss."""
+    index = asm_cache.get(_index_key(digest))
+    if index is None:
+        return None
+    try:
+        used = marshal.loads(index)
+        entry = asm_cache.get(_entry_key(digest, used, line.aliases()))
+        if entry is None:
+            return None
+        version, defines, lines = marshal.loads(entry)
+    except (EOFError, ValueError, TypeError):
+        return None
+    if version != FORMAT_VERSION:
+        return None
+    for name, value in defines:
+        line.add_alias(name, value)
+    op_lines = []
+    for line_number, command, args in lines:
+        if command in ['asm', 'c2']:
+            args = [*args[:-1], asm.PendingAsm.completed(args[-1])]
+        op_lines.append(MGCLine(line_number, command, args))
+    return op_lines
+
+
+def store(digest: str, used: set[str], outer: dict[str, str],
+          op_lines: list[MGCLine]) -> None:
+    """Caches the parse of an MGC file, given its file_digest, the names of
+    the aliases it used and the aliases defined before it was parsed. The
+    entry is written once its ASM has compiled, and never if that fails."""
+    index_key = _index_key(digest)
+    if not index_key:
+        return
+    used = sorted(used)
+    entry_key = _entry_key(digest, used, outer)
+    defines = [(name, value) for name, value in line.aliases().items()
+               if outer.get(name) != value]
+    asm_lines = [op for op in op_lines if op.command in ['asm', 'c2']]
+
+    def write(compiled: list[bytes]):
+        compiled = dict(zip(map(id, asm_lines), compiled))
+        lines = []
+        for op in op_lines:
+            args = op.args
+            if id(op) in compiled:
+                args = [*args[:-1], compiled[id(op)]]
+            lines.append((op.line_number, op.command, args))
+        asm_cache.put(index_key, marshal.dumps(used))
+        asm_cache.put(entry_key, marshal.dumps((FORMAT_VERSION, defines, lines)))
+
+    asm.on_compiled([op.args[-1] for op in asm_lines], write)
@@ -0,0 +1,64 @@
+"""elf.py: Reads the sections of the big-endian ELF32 object files produced by
+powerpc-eabi-as, so code that doesn't need linking can skip ld and objcopy."""
+import struct
+from typing import NamedTuple
+
+SHT_PROGBITS = 1
+SHT_RELA = 4
+SHT_NOBITS = 8
+SHT_REL = 9
+SHF_ALLOC = 0x2
+
+
+class Section(NamedTuple):
+    name: str
+    type: int
+    flags: int
+    size: int
+    data: bytes
+    info: int
+
+
+def read_sections(path) -> list[Section]:
+    """Reads every section of an ELF32 big-endian object file."""
+    with open(path, "rb") as f:
+        return parse_sections(f.read())
+
+
+def parse_sections(elf: bytes) -> list[Section]:
+    """Parses every section of an ELF32 big-endian object in memory."""
+    if elf[:4] != b"\x7fELF" or elf[4] != 1 or elf[5] != 2:
+        raise ValueError("Not a big-endian ELF32 file")
+    shoff, = struct.unpack_from(">I", elf, 0x20)
+    shentsize, shnum, shstrndx = struct.unpack_from(">HHH", elf, 0x2e)
+    headers = [struct.unpack_from(">IIIIIIIIII", elf, shoff + i * shentsize)
+               for i in range(shnum)]
+    strtab_offset = headers[shstrndx][4]
+    sections = []
+    for name, type, flags, _, offset, size, _, info, _, _ in headers:
+        name_end = elf.index(b"\0", strtab_offset + name)
+        data = b"" if type == SHT_NOBITS else elf[offset:offset + size]
+        sections.append(Section(elf[strtab_offset + name:name_end].decode(),
+                                type, flags, size, data, info))
+    return sections
+
+
+def unlinked_sections(obj, names: list[str]) -> list[bytes]:
+    """Returns the contents of the named sections straight from an unlinked
+    object, given as a path or as bytes, or None if linking could change the
+    output: if there are relocations against loaded sections, or loaded data
+    outside the named sections."""
+    if isinstance(obj, bytes):
+        sections = parse_sections(obj)
+    else:
+        sections = read_sections(obj)
+    for section in sections:
+        if section.type in (SHT_REL, SHT_RELA):
+            target = sections[section.info]
+            if target.flags & SHF_ALLOC:
+                return None
+        elif (section.flags & SHF_ALLOC) and section.size:
+            if section.type == SHT_NOBITS or section.name not in names:
+                return None
+    found = {section.name: section.data for section in sections}
+    return [found.get(name, b"") for name in names]
@@ -24,12 +24,28 @@
 #  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 #  SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import os
+import contextvars
 import platform
 import subprocess
+import hashlib
+import struct
+import threading
 from pathlib import Path
+from typing import NamedTuple
 from .errors import CodetypeError
+from . import elf
 
 eabi = {}
+_toolchain = None
+_versions = {}
+_probe_lock = threading.Lock()
+# Whether as can be run on pipes, with the object coming back through an
+# anonymous in-memory file instead of the disk
+use_pipes = hasattr(os, "memfd_create")
+# Optional replacement for subprocess.run when starting toolchain processes,
+# called as runner(args, input, pass_fds) -> (stdout, stderr)
+runner = contextvars.ContextVar("runner", default=None)
 
 def setup():
 
@@ -45,34 +61,148 @@ def setup():
     eabi['ld'] = platform_folder/("powerpc-eabi-ld" + file_extension)
     eabi['objcopy'] = platform_folder/("powerpc-eabi-objcopy" + file_extension)
 
-def asm_opcodes(tmpdir, txtfile=None, binfile=None):
-    for i in ("as", "ld", "objcopy"):
-        if not eabi[i].exists():
-            raise IOError(str(eabi[i]) + " not found")
+class Toolchain(NamedTuple):
+    """The probed toolchain binaries: their paths, and a hash of their
+    contents that identifies the toolchain in cache keys."""
+    paths: dict
+    hash: str
+
+def toolchain():
+    """Checks that the toolchain binaries exist and hashes them, once per
+    process. Raises IOError if any are missing."""
+    global _toolchain
+    with _probe_lock:
+        if _toolchain is None:
+            h = hashlib.sha256()
+            for i in ("as", "ld", "objcopy"):
+                if not eabi[i].exists():
+                    raise IOError(str(eabi[i]) + " not found")
+                with open(eabi[i], "rb") as f:
+                    h.update(hashlib.sha256(f.read()).digest())
+            _toolchain = Toolchain(dict(eabi), h.hexdigest())
+    return _toolchain
+
+def toolchain_hash():
+    """Returns a hash of the toolchain binaries, computed once per process."""
+    return toolchain().hash
+
+def version(tool="as"):
+    """Returns the first line of a tool's --version output, probed once per
+    process."""
+    paths = toolchain().paths
+    with _probe_lock:
+        if tool not in _versions:
+            output = _run([str(paths[tool]), "--version"])
+            _versions[tool] = output[0].decode(errors="replace").partition("\n")[0]
+    return _versions[tool]
+
+def _run(args, input=None, pass_fds=()):
+    run = runner.get()
+    if run is not None:
+        return run(args, input, pass_fds)
+    output = subprocess.run(args, input=input, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, pass_fds=pass_fds)
+    return output.stdout, output.stderr
+
+def _assemble(tmpdir, txtfile=None):
+    paths = toolchain().paths
 
     if txtfile is None:
         txtfile = tmpdir.joinpath("code.txt")
-    if binfile is None:
-        binfile = tmpdir.joinpath("code.bin")
     src1file = tmpdir.joinpath("src1.o")
-    src2file = tmpdir.joinpath("src2.o")
 
-    output = subprocess.Popen([str(eabi["as"]), "-W", "-mregnames", "-mgekko", "-o", 
-        str(src1file), str(txtfile)], stdout=subprocess.PIPE, 
-        stderr=subprocess.PIPE).communicate()
+    output = _run([str(paths["as"]), "-W", "-mregnames", "-mgekko", "-o",
+        str(src1file), str(txtfile)])
 
     if output[1]:
         errormsg = output[1]
         raise RuntimeError(errormsg)
+    return src1file
+
+def _assemble_pipe(source):
+    paths = toolchain().paths
+
+    fd = os.memfd_create("mgc-obj")
+    try:
+        output = _run([str(paths["as"]), "-W", "-mregnames", "-mgekko", "-o",
+            "/dev/fd/%d" % fd], source.encode(), (fd,))
+        if output[1]:
+            raise RuntimeError(output[1])
+        with open(fd, "rb", closefd=False) as f:
+            return f.read()
+    finally:
+        os.close(fd)
 
-    subprocess.Popen([str(eabi["ld"]), "-Ttext", "0x80000000", "-o", 
-        str(src2file), str(src1file)], stderr=subprocess.PIPE).communicate()
-    subprocess.Popen([str(eabi["objcopy"]), "-O", "binary", 
-        str(src2file), binfile], stderr=subprocess.PIPE).communicate()
+def _link(tmpdir, src1file, binfile=None, ldargs=("-Ttext", "0x80000000")):
+    if binfile is None:
+        binfile = tmpdir.joinpath("code.bin")
+    src2file = tmpdir.joinpath("src2.o")
+
+    paths = toolchain().paths
+    _run([str(paths["ld"])] + list(ldargs) + ["-o", str(src2file), str(src1file)])
+    _run([str(paths["objcopy"]), "-O", "binary", str(src2file), str(binfile)])
     
     with open(binfile, "rb") as f:
-        rawhex = f.read().hex()
-    return rawhex
+        return f.read()
+
+def asm_opcodes(tmpdir, txtfile=None, binfile=None):
+    src1file = _assemble(tmpdir, txtfile)
+
+    # Code without relocations is already final, so ld and objcopy can be
+    # skipped by reading .text straight out of the object file
+    text = elf.unlinked_sections(src1file, [".text"])
+    if text is not None:
+        return text[0].hex()
+    return _link(tmpdir, src1file, binfile).hex()
+
+def pipe_opcodes(source):
+    """Assembles source text without touching the disk and returns the bytes.
+    Returns None if the code needs linking, which has to be done with
+    asm_opcodes instead."""
+    text = elf.unlinked_sections(_assemble_pipe(source), [".text"])
+    if text is None:
+        return None
+    return text[0]
+
+def pipe_sections(source, names):
+    """Like asm_sections, but without touching the disk. Returns None if the
+    code needs linking."""
+    return elf.unlinked_sections(_assemble_pipe(source), names)
+
+def asm_sections(tmpdir, names, txtfile=None, binfile=None):
+    """Assembles a source file containing the named sections and returns the
+    bytes of each, as if each section were linked on its own at 0x80000000."""
+    src1file = _assemble(tmpdir, txtfile)
+
+    sections = elf.unlinked_sections(src1file, names)
+    if sections is not None:
+        return sections
+
+    # Link every section at the same address, but load them back to back
+    # followed by a table of their sizes, so the output can be split up
+    script = ["SECTIONS {"]
+    load_address = "0"
+    for name in names:
+        script.append("  %s 0x80000000 : AT(%s) { *(%s) . = .; }" % (name, load_address, name))
+        load_address = "LOADADDR(%s) + SIZEOF(%s)" % (name, name)
+    sizes = " ".join("LONG(SIZEOF(%s))" % name for name in names)
+    script.append("  .sizes 0 : AT(%s) { %s }" % (load_address, sizes))
+    script.append("}")
+    ldscript = tmpdir.joinpath("code.ld")
+    with open(ldscript, "w") as f:
+        f.write("\n".join(script) + "\n")
+
+    linked = _link(tmpdir, src1file, binfile, ["--no-check-sections", "-T", str(ldscript)])
+    table = linked[-4 * len(names):]
+    sizes = [int.from_bytes(table[i:i+4], "big") for i in range(0, len(table), 4)]
+    if sum(sizes) + len(table) != len(linked):
+        raise RuntimeError("Linked sections don't match their size table")
+    sections = []
+    offset = 0
+    for size in sizes:
+        sections.append(linked[offset:offset+size])
+        offset += size
+    return sections
 
 def construct_code(rawhex, bapo=None, xor=None, chksum=None, ctype=None):
     if ctype is None:
@@ -115,5 +245,26 @@ def construct_code(rawhex, bapo=None, xor=None, chksum=None, ctype=None):
                raise CodetypeError("Number of lines (" + 
                        numlines + ") must be lower than 0xFF")
 
+def construct_code_bytes(raw, address=None, ctype="C2D2"):
+    """Same as construct_code for C0 and C2/C3/D2/D3 codes, but working on
+    bytes. raw is any bytes-like object and address is an integer."""
+    numlines = len(raw) // 8 + 1
+    padded = len(raw) % 8 > 0
+    if ctype == "C0":
+        header = struct.pack(">II", 0xC0000000, numlines)
+        footer = b"\x4E\x80\x00\x20" if padded else b"\x4E\x80\x00\x20\x00\x00\x00\x00"
+        return b"".join((header, raw, footer))
+    if ctype != "C2D2":
+        raise CodetypeError("Unsupported codetype '" + str(ctype) + "'")
+
+    region = address >> 24
+    if not 0 <= address <= 0xFFFFFFFF or region not in (0x80, 0x81, 0x00, 0x01):
+        bapo = "%08x" % address
+        raise CodetypeError("Invalid bapo '" + bapo[:2] + "'")
+    codetype = (0xC2 if region & 0x80 else 0xD2) + (region & 1)
+    header = struct.pack(">II", codetype << 24 | address & 0xFFFFFF, numlines)
+    footer = b"\x00\x00\x00\x00" if padded else b"\x60\x00\x00\x00\x00\x00\x00\x00"
+    return b"".join((header, raw, footer))
+
 
 setup()
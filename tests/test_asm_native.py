@@ -0,0 +1,140 @@
+"""Differential test of the in-process assembler against powerpc-eabi-as.
+Every line the native assembler accepts must assemble to the same bytes with
+binutils, and every line it rejects must fall back cleanly."""
+import random
+import unittest
+from mgc import asm_native
+from mgc.pyiiasmh import ppctools
+
+
+# Hand-picked operand forms and expressions, including ones binutils rejects
+_EDGE_CASES = [
+    'lwz r3,0(r4)', 'lwz r3,-4(r1)', 'stwu r1,-0x20(r1)', 'lwz r3,(r4)',
+    'lwz r3, (r4)', 'la r3,8(r4)', 'la r3,(r4)', 'lfs f1,0x10(r31)',
+    'li r3,8>>1', 'li r7,-57576>>16', 'li r3,-8>>1', 'li r3,-8<<1',
+    'li r3,0x7fff', 'li r3,0x8000', 'li r3,-0x8000', 'lis r3,0xffff',
+    'lis r3,0x8045@ha', 'addi r3,r3,0x80451234@l', 'ori r3,r3,0xffff',
+    'ori r3,r3,-1', 'li r3,(1+2)*3', 'li r3,1+2&3', 'li r3,~5', 'li r3,-7/2',
+    'li r3,7%-2', 'li r3,010', 'li r3,09', 'li r3,0b101', 'subi r3,r3,0x8000',
+    'subis r3,r3,1', 'lwzu r3,4(r3)', 'lwzu r3,4(r0)', 'lmw r30,8(r31)',
+    'lmw r29,8(r29)', 'cmpwi cr7,r3,-1', 'cmplwi r3,0xffff', 'rlwinm r3,r4,2,0,29',
+    'slwi r3,r4,32', 'mtspr 912,r3', 'mflr r0', 'blr', 'bnelr cr1', 'b 0x10',
+    'bl -0x4', 'beq+ cr7,0x8', 'bdnz -0x8', 'nop',
+]
+
+
+def _register(r: random.Random) -> str:
+    return r.choice([f'r{r.randrange(32)}', 'sp', 'rtoc', str(r.randrange(32))])
+
+
+def _immediate(r: random.Random) -> str:
+    value = r.choice([0, 1, -1, 0x7fff, -0x8000, 0x8000, 0xffff, 0x10000,
+                      r.randrange(-0x10000, 0x20000), r.randrange(0x100000000)])
+    text = str(value) if r.random() < 0.5 else ('-' if value < 0 else '') + hex(abs(value))
+    match r.randrange(12):
+        case 0: return text + '@ha'
+        case 1: return text + '@h'
+        case 2: return text + '@l'
+        case 3: return f'({text})+{r.randrange(10)}*2'
+        case 4: return f'{text}>>{r.randrange(20)}'
+        case 5: return f'{text}<<{r.randrange(4)}|1'
+        case 6: return f'-{r.randrange(50)}/7'
+        case _: return text
+
+
+def _random_line(r: random.Random) -> str:
+    match r.randrange(9):
+        case 0:
+            return r.choice(list(asm_native._FIXED))
+        case 1:
+            mnemonic = r.choice(list(asm_native._D_ARITH) + ['subi', 'subis', 'subic'])
+            return f'{mnemonic} {_register(r)},{_register(r)},{_immediate(r)}'
+        case 2:
+            return f'{r.choice(["li", "lis"])} {_register(r)},{_immediate(r)}'
+        case 3:
+            mnemonic = r.choice(list(asm_native._D_LOGICAL))
+            return f'{mnemonic} {_register(r)},{_register(r)},{_immediate(r)}'
+        case 4:
+            displacement = _immediate(r) if r.random() < 0.9 else ''
+            mnemonic = r.choice(list(asm_native._LOAD_STORE) + ['la'])
+            return f'{mnemonic} {_register(r)},{displacement}({_register(r)})'
+        case 5:
+            mnemonic = r.choice(list(asm_native._FLOAT_LOAD_STORE))
+            return f'{mnemonic} f{r.randrange(32)},{_immediate(r)}({_register(r)})'
+        case 6:
+            mnemonic = r.choice(['cmpwi', 'cmplwi'])
+            return f'{mnemonic} cr{r.randrange(8)},{_register(r)},{_immediate(r)}'
+        case 7:
+            mnemonic = r.choice(list(asm_native._XO_ARITH)) + r.choice(['', 'o', '.', 'o.'])
+            return f'{mnemonic} {_register(r)},{_register(r)},{_register(r)}'
+        case _:
+            mnemonic = r.choice(['rlwinm', 'rlwimi']) + r.choice(['', '.'])
+            fields = ','.join(str(r.randrange(-1, 34)) for _ in range(3))
+            return f'{mnemonic} {_register(r)},{_register(r)},{fields}'
+
+
+def _binutils(lines: list[str]) -> bytes:
+    """Assembles lines with powerpc-eabi-as, or returns None if it rejects
+    them."""
+    try:
+        return ppctools.pipe_opcodes('\n'.join(lines) + '\n')
+    except RuntimeError:
+        return None
+
+
+class TestNativeAssembler(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if not ppctools.use_pipes:
+            raise unittest.SkipTest("Piping to the toolchain isn't supported here")
+        try:
+            ppctools.toolchain()
+        except OSError as e:
+            raise unittest.SkipTest(f"Toolchain unavailable: {e}")
+
+    def _check(self, lines: list[str]):
+        accepted = []
+        for line in lines:
+            try:
+                accepted.append((line, asm_native.assemble(line)))
+            except asm_native.Unsupported:
+                continue
+        self._compare(accepted)
+
+    def _compare(self, accepted: list[tuple[str, bytes]]):
+        """Assembles the accepted lines in bulk, and splits up any chunk
+        that doesn't match to find the lines responsible."""
+        if not accepted:
+            return
+        expected = b''.join(data for _, data in accepted)
+        if _binutils([line for line, _ in accepted]) == expected:
+            return
+        if len(accepted) > 1:
+            half = len(accepted) // 2
+            self._compare(accepted[:half])
+            self._compare(accepted[half:])
+            return
+        line, data = accepted[0]
+        actual = _binutils([line])
+        with self.subTest(line=line):
+            self.assertIsNotNone(actual, f"binutils rejects {line!r}")
+            self.assertEqual(actual.hex(), data.hex())
+
+    def test_edge_cases(self):
+        self._check(_EDGE_CASES)
+
+    def test_rejected_by_binutils(self):
+        for line in ['lwz r3,(r4)', 'la r3,(r4)', 'li r7,-57576>>16']:
+            with self.subTest(line=line):
+                self.assertIsNone(_binutils([line]))
+                with self.assertRaises(asm_native.Unsupported):
+                    asm_native.assemble(line)
+
+    def test_random_corpus(self):
+        r = random.Random(1)
+        self._check([_random_line(r) for _ in range(2000)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+"""Cross-checks the strided GCI checksum against the byte-at-a-time
+reference implementation."""
+import random
+import unittest
+from mgc.gci_tools.meleegci import melee_gci
+
+
+class TestChecksum(unittest.TestCase):
+
+    def _check(self, data: bytearray, offset: int, count: int):
+        gci = melee_gci(raw_bytes=data)
+        self.assertEqual(gci._checksum(offset, count),
+                         gci._checksum_reference(offset, count),
+                         (offset, count))
+
+    def test_random_blocks(self):
+        r = random.Random(4)
+        for _ in range(200):
+            count = r.choice([0x1ff0, 0x2000, r.randrange(1, 0x2000)])
+            offset = r.randrange(0x100)
+            # The reference reads whole groups of 8, so pad past the end
+            size = offset + -(-count // 8) * 8 + r.randrange(16)
+            data = bytearray(r.randbytes(size))
+            self._check(data, offset, count)
+
+    def test_equal_neighbours(self):
+        # Slot 0 is seeded with 0x01 and slot 1 with 0x23, so adding 0x22 to
+        # slot 0 makes them equal and takes the XOR path
+        data = bytearray(0x20)
+        data[0] = 0x22
+        gci = melee_gci(raw_bytes=data)
+        self.assertEqual(gci._checksum_reference(0, 0x20)[1], 0x23 ^ 0xff)
+        self._check(data, 0, 0x20)
+
+
+if __name__ == '__main__':
+    unittest.main()
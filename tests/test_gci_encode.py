@@ -0,0 +1,30 @@
+"""Checks the precomputed GCI encode and decode tables against the reference
+encode_byte and decode_byte implementations."""
+import unittest
+from mgc.gci_tools import gci_encode
+
+
+class TestTables(unittest.TestCase):
+
+    def test_shipped_tables_match_reference(self):
+        encode_table, decode_table = gci_encode.build_tables()
+        with open(gci_encode.TABLE_PATH, 'rb') as f:
+            shipped = f.read()
+        self.assertEqual(len(shipped), gci_encode.TABLE_SIZE * 2)
+        self.assertEqual(shipped[:gci_encode.TABLE_SIZE], encode_table)
+        self.assertEqual(shipped[gci_encode.TABLE_SIZE:], decode_table)
+        self.assertEqual(gci_encode.ENCODE_TABLE, encode_table)
+        self.assertEqual(gci_encode.DECODE_TABLE, decode_table)
+
+    def test_round_trip(self):
+        encode_table = gci_encode.ENCODE_TABLE
+        decode_table = gci_encode.DECODE_TABLE
+        for prev_byte in range(256):
+            for byte in range(256):
+                encoded = encode_table[prev_byte << 8 | byte]
+                self.assertEqual(decode_table[prev_byte << 8 | encoded], byte,
+                                 (prev_byte, byte))
+
+
+if __name__ == '__main__':
+    unittest.main()